@@ -0,0 +1,177 @@
+# Copyright New York University and the in-toto contributors
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+<Program Name>
+  _link_files.py
+
+<Copyright>
+  See LICENSE for licensing information.
+
+<Purpose>
+  Provides helpers for `runlib` to find, load and verify preliminary link
+  metadata files and to store link metadata files atomically.
+
+"""
+import logging
+import os
+import re
+
+import in_toto.exceptions
+
+from in_toto.models.link import UNFINISHED_FILENAME_FORMAT_GLOB
+from in_toto.models.metadata import Metadata
+
+import securesystemslib.gpg
+from securesystemslib.signer import Signature
+
+# Inherits from in_toto base logger (c.f. in_toto.log)
+LOG = logging.getLogger(__name__)
+
+
+def dump_atomic(link_metadata, fn, fsync=False, fsync_dir=True):
+  """Helper to write link metadata to a temporary file next to fn, which then
+  atomically replaces fn, so that readers never see a partially written link.
+  The metadata is serialized once and written with a single write call. The
+  temporary file, and after replacing fn the containing directory, are only
+  synced to disk, if fsync is True, because it costs disk flushes per link.
+  Pass fsync_dir=False, to sync the directory later, e.g. after further
+  changes. """
+  blob = link_metadata.to_bytes()
+  tmp_fn = fn + ".tmp"
+  try:
+    with open(tmp_fn, "wb") as fp:
+      fp.write(blob)
+      if fsync:
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.replace(tmp_fn, fn)
+
+  except BaseException:
+    if os.path.exists(tmp_fn):
+      os.remove(tmp_fn)
+    raise
+
+  if fsync and fsync_dir:
+    fsync_directory(os.path.dirname(fn))
+
+
+def fsync_directory(dirpath):
+  """Helper to sync a directory to disk, which persists renamed and removed
+  entries. Not supported on Windows, where directories cannot be opened. """
+  if not hasattr(os, "O_DIRECTORY"):
+    return
+
+  fd = os.open(dirpath or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def atomic_finalize(link_metadata, fn, unfinished_fn, fsync=False):
+  """Helper to store the final link metadata at fn and remove the preliminary
+  link metadata file at unfinished_fn. The final link atomically replaces fn,
+  so that a crash leaves at most the preliminary link behind, next to a
+  complete final link. If fsync is True, file contents and finally the
+  containing directories are synced to disk once. """
+  LOG.info("Storing link metadata to '{}'...".format(fn))
+  dump_atomic(link_metadata, fn, fsync=fsync, fsync_dir=False)
+
+  LOG.info("Removing unfinished link metadata '{}'...".format(unfinished_fn))
+  os.unlink(unfinished_fn)
+
+  if fsync:
+    for dirpath in {os.path.dirname(os.path.abspath(path))
+        for path in (fn, unfinished_fn)}:
+      fsync_directory(dirpath)
+
+
+def _compile_unfinished_filename_re():
+  """Helper to compile a regex, which matches the names of preliminary link
+  files (see UNFINISHED_FILENAME_FORMAT_GLOB), capturing step name and keyid.
+  """
+  prefix, infix, suffix = UNFINISHED_FILENAME_FORMAT_GLOB.format(
+      step_name="\0", pattern="\0").split("\0")
+
+  return re.compile("{}(?P<step_name>.+){}(?P<keyid>[0-9a-fA-F]+){}$".format(
+      re.escape(prefix), re.escape(infix), re.escape(suffix)))
+
+
+UNFINISHED_FILENAME_RE = _compile_unfinished_filename_re()
+
+
+def find_unfinished(step_name, max_matches=2):
+  """Helper to find the names of preliminary link files for the passed step
+  name in the current working directory, i.e. names that match
+  UNFINISHED_FILENAME_FORMAT_GLOB for any keyid. Stops after max_matches
+  names are found, which is enough to tell if there is exactly one. """
+  matches = []
+  with os.scandir(os.curdir) as entries:
+    for entry in entries:
+      match = UNFINISHED_FILENAME_RE.match(entry.name)
+      if match and match.group("step_name") == step_name:
+        matches.append(entry.name)
+        if len(matches) == max_matches:
+          break
+
+  return matches
+
+
+def load_preliminary_link(unfinished_fn, signing_key=None, gpg_keyid=None,
+    gpg_home=None, skip_verify=False):
+  """Helper to load the preliminary link metadata file and verify its
+  signature with the passed signing key, or with the passed or default gpg
+  key. Returns the link metadata and the keyid of the verification key.
+
+  If skip_verify is True and a signing key is passed, only checks that the
+  file has a signature with the keyid of the signing key (see
+  runlib.in_toto_record_stop). """
+  LOG.info("Loading preliminary link metadata '{}'...".format(unfinished_fn))
+  link_metadata = Metadata.load(unfinished_fn)
+
+  # The file must have been signed by the same key
+  # If we have a signing_key we use it for verification as well
+  if signing_key:
+    LOG.info(
+        "Verifying preliminary link signature using passed signing key...")
+    keyid = signing_key["keyid"]
+    verification_key = signing_key
+
+  elif gpg_keyid:
+    LOG.info("Verifying preliminary link signature using passed gpg key...")
+    gpg_pubkey = securesystemslib.gpg.functions.export_pubkey(gpg_keyid,
+        gpg_home)
+    keyid = gpg_pubkey["keyid"]
+    verification_key = gpg_pubkey
+
+  else: # must be gpg_use_default
+    # FIXME: Currently there is no way to know the default GPG key's keyid
+    # before signing. As a workaround we extract the keyid of the preliminary
+    # Link file's signature and try to export a pubkey from the gpg
+    # home directory. We do this even if a gpg_keyid was specified, because gpg
+    # accepts many different ids (mail, name, parts of an id, ...) but we
+    # need a specific format.
+    LOG.info("Verifying preliminary link signature using default gpg key...")
+    # signatures are objects in DSSE.
+    sig = link_metadata.signatures[0]
+    if isinstance(sig, Signature):
+      keyid = sig.keyid
+    else:
+      keyid = sig["keyid"]
+    gpg_pubkey = securesystemslib.gpg.functions.export_pubkey(keyid, gpg_home)
+    verification_key = gpg_pubkey
+
+  if skip_verify and signing_key:
+    LOG.info("Skipping verification of preliminary link signature...")
+    keyids = [sig.keyid if isinstance(sig, Signature) else sig["keyid"]
+        for sig in link_metadata.signatures]
+    if keyid not in keyids:
+      raise in_toto.exceptions.SignatureVerificationError(
+          "No signature found for key '{}'".format(keyid))
+
+  else:
+    link_metadata.verify_signature(verification_key)
+
+  return link_metadata, keyid
@@ -29,9 +29,39 @@
   otherwise).
 
 """
+import securesystemslib.formats
 import securesystemslib.schema as ssl_schema
 
 PARAMETER_DICTIONARY_KEY = ssl_schema.RegularExpression(r'[a-zA-Z0-9_-]+')
 PARAMETER_DICTIONARY_SCHEMA = ssl_schema.DictOf(
     key_schema = PARAMETER_DICTIONARY_KEY,
     value_schema = ssl_schema.AnyString())
+
+class _ListItemSchema(ssl_schema.Schema):
+  """Matches objects, which the passed list schema matches as sole item of a
+  list, e.g. to extend the alternatives of a securesystemslib list schema. """
+
+  def __init__(self, list_schema):
+    self._list_schema = list_schema
+
+  def check_match(self, object):  # pylint: disable=redefined-builtin
+    self._list_schema.check_match([object])
+
+
+# Block-wise tree hash algorithms, which can be requested in addition to (or
+# instead of) the hash algorithms supported by securesystemslib, mapped to
+# their underlying hash algorithm and block size. The digest of a tree hash is
+# the hash of the concatenated digests of all blocks of a file, so that the
+# blocks of large files can be hashed in parallel (see
+# `in_toto.runlib._TreeDigest`).
+TREE_HASH_ALGORITHMS = {
+  "sha256-tree-1m": ("sha256", 1 << 20),
+}
+
+# Hash algorithms supported for recording artifacts, i.e. the algorithms of
+# securesystemslib.formats.HASHALGORITHMS_SCHEMA, the tree hash algorithms
+# above and "blake3", which requires the optional blake3 package
+HASH_ALGORITHMS_SCHEMA = ssl_schema.ListOf(ssl_schema.OneOf(
+    [_ListItemSchema(securesystemslib.formats.HASHALGORITHMS_SCHEMA)] +
+    [ssl_schema.String(algorithm)
+        for algorithm in list(TREE_HASH_ALGORITHMS) + ["blake3"]]))
@@ -26,6 +26,11 @@ import attr
 import json
 from typing import Union
 
+try:
+  import orjson
+except ImportError: # pragma: no cover
+  orjson = None
+
 import securesystemslib.keys
 import securesystemslib.formats
 import securesystemslib.exceptions
@@ -44,6 +49,24 @@ from in_toto.models.layout import Layout
 ENVELOPE_PAYLOAD_TYPE = "application/vnd.in-toto+json"
 
 
+def _json_loads(data):
+  """Parses UTF-8 encoded JSON bytes, using the optional orjson package, if
+  installed, and the standard library json module otherwise. """
+  if orjson is not None:
+    return orjson.loads(data)
+
+  return json.loads(data.decode("utf-8"))
+
+
+def _signable_to_bytes(signable):
+  """Returns the passed Signable as UTF-8 encoded JSON bytes, as used for
+  DSSE payloads. """
+  return json.dumps(
+    attr.asdict(signable),
+    sort_keys=True,
+  ).encode("utf-8")
+
+
 class Metadata:
   """A Metadata abstraction between DSSE Envelope and Metablock."""
 
@@ -80,11 +103,19 @@ class Metadata:
       A Metadata containing a Link or Layout object.
 
     """
-    with open(path, "r", encoding="utf8") as fp:
-      data = json.load(fp)
+    with open(path, "rb") as fp:
+      data = _json_loads(fp.read())
 
     return cls.from_dict(data)
 
+  def to_bytes(self):
+    """Returns the UTF-8 encoded JSON string representation, as written to
+    disk by dump."""
+    return json.dumps(
+      self.to_dict(),
+      sort_keys=True,
+    ).encode("utf-8")
+
   def dump(self, path):
     """Writes the JSON string representation of the instance to disk.
 
@@ -95,13 +126,8 @@ class Metadata:
       IOError: File cannot be written.
 
     """
-    json_bytes = json.dumps(
-      self.to_dict(),
-      sort_keys=True,
-    ).encode("utf-8")
-
     with open(path, "wb") as fp:
-      fp.write(json_bytes)
+      fp.write(self.to_bytes())
 
   def create_signature(self, signer: Signer) -> Signature:
     """Creates signature over signable with Signer and adds it to signatures.
@@ -139,6 +165,11 @@ class Metadata:
     """Returns ``Link`` or ``Layout``."""
     raise NotImplementedError  # pragma: no cover
 
+  def set_payload(self, payload):
+    """Replaces the payload with the passed ``Link`` or ``Layout`` in place,
+    and removes all signatures, which no longer match the payload."""
+    raise NotImplementedError  # pragma: no cover
+
 
 class Envelope(SSlibEnvelope, Metadata):
   """DSSE Envelope for in-toto payloads."""
@@ -147,13 +178,8 @@ class Envelope(SSlibEnvelope, Metadata):
   def from_signable(cls, signable: Signable) -> "Envelope":
     """Creates DSSE envelope with signable bytes as payload."""
 
-    json_bytes = json.dumps(
-      attr.asdict(signable),
-      sort_keys=True,
-    ).encode("utf-8")
-
     return cls(
-      payload=json_bytes,
+      payload=_signable_to_bytes(signable),
       payload_type=ENVELOPE_PAYLOAD_TYPE,
       signatures=[]
     )
@@ -183,7 +209,7 @@ class Envelope(SSlibEnvelope, Metadata):
           Link or Layout.
     """
 
-    data = json.loads(self.payload.decode("utf-8"))
+    data = _json_loads(self.payload)
     _type = data.get("_type")
     if _type == "link":
       return Link.read(data)
@@ -192,6 +218,10 @@ class Envelope(SSlibEnvelope, Metadata):
 
     raise InvalidMetadata
 
+  def set_payload(self, payload: Signable) -> None:
+    self.payload = _signable_to_bytes(payload)
+    self.signatures = []
+
 
 @attr.s(repr=False, init=False)
 class Metablock(Metadata, ValidationMixin):
@@ -237,18 +267,10 @@ class Metablock(Metadata, ValidationMixin):
       )
 
 
-  def dump(self, path):
-    """Writes the JSON string representation of the instance to disk.
-
-    Arguments:
-      path: The path to write the file to.
-
-    Raises:
-      IOError: File cannot be written.
-
-    """
-    with open(path, "wb") as fp:
-      fp.write("{}".format(self).encode("utf-8"))
+  def to_bytes(self):
+    """Returns the UTF-8 encoded JSON string representation, as written to
+    disk by dump. """
+    return "{}".format(self).encode("utf-8")
 
 
   @classmethod
@@ -445,3 +467,9 @@ class Metablock(Metadata, ValidationMixin):
     """Returns signed of the Metablock."""
 
     return self.signed
+
+  def set_payload(self, payload):
+    """Replaces signed of the Metablock and removes all signatures."""
+
+    self.signed = payload
+    self.signatures = []
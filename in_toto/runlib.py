@@ -27,88 +27,592 @@
     - Return Metadata containing a Link object which can be can be signed
       and stored to disk
 """
-import glob
+import atexit
+import codecs
+import collections
+import hashlib
+import json
+import functools
 import logging
+import multiprocessing
 import os
 import itertools
 import io
+import locale
+import mmap
+import re
+import selectors
+import sqlite3
+import stat
 import subprocess  # nosec
 import sys
 import tempfile
+import threading
 import time
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+
 from pathspec import PathSpec
 
+try:
+  import blake3
+except ImportError: # pragma: no cover
+  blake3 = None
+
 import in_toto.settings
 import in_toto.exceptions
+import in_toto.formats
 
+from in_toto._link_files import (atomic_finalize, dump_atomic,
+    find_unfinished, load_preliminary_link)
 from in_toto.models._signer import GPGSigner
 from in_toto.models.link import (UNFINISHED_FILENAME_FORMAT, FILENAME_FORMAT,
-    FILENAME_FORMAT_SHORT, UNFINISHED_FILENAME_FORMAT_GLOB)
-from in_toto.models.metadata import (Metadata, Envelope, Metablock)
+    FILENAME_FORMAT_SHORT)
+from in_toto.models.metadata import Envelope, Metablock
 
 import securesystemslib.formats
-import securesystemslib.hash
 import securesystemslib.exceptions
 import securesystemslib.gpg
-from securesystemslib.signer import SSlibSigner, Signature
+from securesystemslib.signer import SSlibSigner
 
 
 
 # Inherits from in_toto base logger (c.f. in_toto.log)
 LOG = logging.getLogger(__name__)
 
+# Size of the chunks in which artifacts are read for hashing. Large chunks
+# amortize the per-call overhead of passing data to the (OpenSSL) digest
+# objects, which can then run their hardware accelerated (e.g. Intel SHA
+# extensions, ARMv8 crypto extensions) inner loops over many blocks at once.
+_HASH_CHUNK_SIZE = 1 << 20
+
+# Minimum size of artifacts that are memory-mapped for hashing, instead of
+# being read in chunks, so that the digest objects read directly from the page
+# cache without copying the contents into Python buffers first
+_HASH_MMAP_THRESHOLD = 16 << 20
+
+# Number of files sent to a worker process at once, if artifacts are hashed in
+# worker processes (see `HASH_POOL` setting), to amortize the IPC overhead
+_HASH_PROCESS_CHUNKSIZE = 32
+
+# Max number of files of the same directory hashed by one worker thread at once
+_HASH_GROUP_SIZE = 64
+
+# Number of files opened ahead by each worker, and max number of bytes at the
+# start of each, which the kernel is advised to read, while hashing a file
+_HASH_PREFETCH_FILES = 4
+_HASH_PREFETCH_SIZE = 1 << 22
+
+# Per-thread read buffers of _HASH_CHUNK_SIZE bytes, reused for all files
+# hashed by a thread
+_HASH_BUFFERS = threading.local()
+
+# Kinds of worker pools for the HASH_POOL setting (see `in_toto.settings`)
+HASH_POOLS = ("thread", "process")
+
+# Block-wise tree hash algorithms (see `in_toto.formats.TREE_HASH_ALGORITHMS`)
+TREE_HASH_ALGORITHMS = in_toto.formats.TREE_HASH_ALGORITHMS
+
+# In-memory artifact hash cache (see `_hash_artifact`), keyed by a tuple of
+# device, inode, size, modification and change time (in nanoseconds) of a
+# file, the normalize_line_endings flag and the hash algorithm name
+_HASH_CACHE = collections.OrderedDict()
+
+# Hash cache entries to be persisted at interpreter exit (see
+# `_persist_hash_cache`), and persisted hash caches that were already loaded
+_HASH_CACHE_PENDING = collections.OrderedDict()
+_HASH_CACHE_LOADED_PATHS = set()
+
+# Max number of entries kept in the hash cache, in memory and persisted, the
+# least recently added entries are evicted first
+_HASH_CACHE_MAX_ENTRIES = 1 << 16
+
+# Guards the hash cache, which is updated by the worker threads that hash
+# artifacts in parallel
+_HASH_CACHE_LOCK = threading.Lock()
+
+# The hash cache is not used on Windows, where `st_ctime` is the creation time
+# of a file, which unlike the change time is not updated, if the contents of a
+# file are changed and its modification time is reset
+_HASH_CACHE_SUPPORTED = sys.platform != "win32"
+
+# Files changed less than this many nanoseconds before they are hashed are not
+# added to the hash cache, see `_hash_artifact`
+_HASH_CACHE_RACY_NS = 2 * 10**9
+
+
+
+class _TreeDigest:
+  """Digest object for the block-wise tree hash algorithms in
+  TREE_HASH_ALGORITHMS, which hashes data in blocks of a fixed size and
+  returns the hash of the concatenated block digests. """
+
+  def __init__(self, algorithm, block_size):
+    self.algorithm = algorithm
+    self.block_size = block_size
+    self._block_digests = []
+    self._block = hashlib.new(algorithm)
+    self._block_filled = 0
+
+  def update(self, data):
+    """Feeds the passed bytes-like data to the digests of the current and,
+    if necessary, of subsequent blocks. """
+    data = memoryview(data)
+    while data:
+      size = min(len(data), self.block_size - self._block_filled)
+      self._block.update(data[:size])
+      self._block_filled += size
+      data = data[size:]
+
+      if self._block_filled == self.block_size:
+        self._block_digests.append(self._block.digest())
+        self._block = hashlib.new(self.algorithm)
+        self._block_filled = 0
+
+  def update_parallel(self, data, max_workers):
+    """Same as update, but hashes the full blocks of the passed bytes-like
+    data in parallel, using a pool of max_workers threads. """
+    # Complete a partially filled block first, to align the remaining blocks
+    view = memoryview(data)
+    offset = 0
+    if self._block_filled:
+      offset = min(len(view), self.block_size - self._block_filled)
+      self.update(view[:offset])
+
+    end = offset + (len(view) - offset) // self.block_size * self.block_size
+
+    def _block_digest(start):
+      return hashlib.new(self.algorithm,
+          view[start:start + self.block_size]).digest()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      self._block_digests.extend(executor.map(_block_digest,
+          range(offset, end, self.block_size)))
+
+    self.update(view[end:])
+    view.release()
+
+  def hexdigest(self):
+    """Returns the hex digest of the concatenated block digests. """
+    block_digests = list(self._block_digests)
+    if self._block_filled:
+      block_digests.append(self._block.digest())
+
+    return hashlib.new(self.algorithm, b"".join(block_digests)).hexdigest()
+
+
+def _new_digest(algorithm, max_workers=1):
+  """Internal helper that returns a new hashlib digest object for the passed
+  algorithm, supporting the same algorithm names as securesystemslib.hash,
+  and a digest object for the tree hash algorithms in TREE_HASH_ALGORITHMS
+  and for "blake3", if the optional blake3 package is installed. A "blake3"
+  digest object hashes large inputs with up to max_workers threads.
+  """
+  if algorithm in TREE_HASH_ALGORITHMS:
+    return _TreeDigest(*TREE_HASH_ALGORITHMS[algorithm])
+
+  if algorithm == "blake3":
+    if blake3 is None:
+      raise securesystemslib.exceptions.UnsupportedAlgorithmError(
+          "'blake3' requires the blake3 package, install with"
+          " 'pip install in-toto[blake3]'")
+
+    return blake3.blake3(max_threads=max_workers)
+
+  try:
+    if algorithm == "blake2b-256":
+      return hashlib.new("blake2b", digest_size=32)
+
+    return hashlib.new(algorithm)
+
+  except ValueError as e:
+    raise securesystemslib.exceptions.UnsupportedAlgorithmError(
+        algorithm) from e
+
+
+def _digest_file_object(file_object, hash_algorithms,
+    normalize_line_endings=False, file_size=None, max_workers=1):
+  """Internal helper that reads the passed (unbuffered) binary file object
+  only once, in chunks or memory-mapped if it is large, feeds the contents to
+  the digest objects of all passed hash_algorithms, and returns a dictionary
+  of hex digests per algorithm. The file is stat'ed for its size, unless
+  file_size is passed. Memory-mapped contents are hashed with up to
+  max_workers threads, by the algorithms that support it. """
+  # Raises securesystemslib.exceptions.UnsupportedAlgorithmError
+  digest_objects = {algorithm: _new_digest(algorithm, max_workers)
+      for algorithm in hash_algorithms}
+
+  # Memory-map large files, unless line endings need to be normalized, which
+  # requires a modified copy of the contents anyway
+  mapped = None
+  fileno = file_object.fileno()
+  if not normalize_line_endings and file_size is None:
+    file_size = os.fstat(fileno).st_size
+
+  if not normalize_line_endings and file_size >= _HASH_MMAP_THRESHOLD:
+    if hasattr(os, "posix_fadvise"):
+      os.posix_fadvise(fileno, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    try:
+      mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    # Fall back to reading in chunks, if the file cannot be mapped
+    except (OSError, ValueError):
+      pass
+
+  if mapped is not None:
+    with mapped:
+      for digest_object in digest_objects.values():
+        if isinstance(digest_object, _TreeDigest) and max_workers > 1:
+          digest_object.update_parallel(mapped, max_workers)
+
+        else:
+          digest_object.update(mapped)
+
+    return {algorithm: digest_object.hexdigest()
+        for algorithm, digest_object in digest_objects.items()}
+
+  # Let hashlib read and digest smaller files for a single algorithm
+  # (Python 3.11+)
+  if not normalize_line_endings and len(digest_objects) == 1 and \
+      hasattr(hashlib, "file_digest"):
+    (algorithm, digest_object), = digest_objects.items()
+    return {algorithm: hashlib.file_digest(file_object,
+        lambda: digest_object).hexdigest()}
+
+  # Read into a preallocated buffer to avoid allocating a new bytes object for
+  # every chunk, reusing the buffer of the current thread for every file
+  buf = getattr(_HASH_BUFFERS, "buf", None)
+  if buf is None or len(buf) != _HASH_CHUNK_SIZE:
+    buf = _HASH_BUFFERS.buf = bytearray(_HASH_CHUNK_SIZE)
+  view = memoryview(buf)
+
+  # Carriage return held back from the end of the previous chunk, which might
+  # be the first byte of a windows line ending split across two chunks
+  carry = b""
+
+  # Look up bound methods once, instead of per chunk and algorithm
+  readinto = file_object.readinto
+  updates = [digest_object.update for digest_object in digest_objects.values()]
+
+  while True:
+    size = readinto(buf)
+    if not size:
+      break
+
+    # Chunks without carriage returns, e.g. of files with unix line endings,
+    # are hashed as they are, without copying them
+    if normalize_line_endings and (carry or buf.find(b"\r", 0, size) != -1):
+      end = size - 1 if buf[size - 1] == ord("\r") else size
+      data = carry + view[:end]
+      carry = bytes(view[end:size])
+      # First windows, then mac line endings
+      data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    else:
+      data = view[:size]
+
+    for update in updates:
+      update(data)
+
+  # A carriage return at the very end of the file is a mac line ending
+  if carry:
+    for update in updates:
+      update(b"\n")
+
+  return {algorithm: digest_object.hexdigest()
+      for algorithm, digest_object in digest_objects.items()}
+
+
+def _hash_cache_enabled():
+  """Internal helper to return if the hash cache is enabled per the
+  HASH_CACHE_ENABLED setting and supported on this platform. """
+  return bool(in_toto.settings.HASH_CACHE_ENABLED) and _HASH_CACHE_SUPPORTED
+
+
+def _load_hash_cache(path):
+  """Internal helper to add artifact hashes persisted at the passed path by
+  `_persist_hash_cache` to the in-memory hash cache. """
+  if path in _HASH_CACHE_LOADED_PATHS:
+    return
+
+  _HASH_CACHE_LOADED_PATHS.add(path)
+  if not os.path.isfile(path):
+    return
+
+  try:
+    with closing(sqlite3.connect(path)) as connection:
+      rows = connection.execute("SELECT key, digest FROM hashes"
+          " ORDER BY rowid DESC LIMIT ?", (_HASH_CACHE_MAX_ENTRIES,)
+          ).fetchall()
+
+  except sqlite3.Error as e:
+    LOG.warning("Could not load hash cache '{}': {}".format(path, e))
+    return
+
+  # Rows are returned most recently persisted first, add them the other way
+  # round, so that the former are evicted last
+  with _HASH_CACHE_LOCK:
+    for key, digest in reversed(rows):
+      _HASH_CACHE.setdefault(tuple(json.loads(key)), digest)
+    _evict_hash_cache(_HASH_CACHE)
+
+
+def _evict_hash_cache(cache):
+  """Internal helper to evict the least recently added entries from the passed
+  hash cache, until it has no more than _HASH_CACHE_MAX_ENTRIES entries. Must
+  be called with _HASH_CACHE_LOCK held. """
+  while len(cache) > _HASH_CACHE_MAX_ENTRIES:
+    cache.popitem(last=False)
+
+
+def _add_to_hash_cache(key, digest):
+  """Internal helper to add a hash to the in-memory hash cache and, if the
+  HASH_CACHE_PATH setting is set, to the entries to be persisted. """
+  with _HASH_CACHE_LOCK:
+    _HASH_CACHE[key] = digest
+    _HASH_CACHE.move_to_end(key)
+    _evict_hash_cache(_HASH_CACHE)
+
+    if in_toto.settings.HASH_CACHE_PATH:
+      _HASH_CACHE_PENDING[key] = digest
+      _HASH_CACHE_PENDING.move_to_end(key)
+      _evict_hash_cache(_HASH_CACHE_PENDING)
+
+
+def _persist_hash_cache():
+  """Internal helper to persist artifact hashes, which were newly added to the
+  in-memory hash cache, at the HASH_CACHE_PATH setting. Registered to run at
+  interpreter exit. """
+  path = in_toto.settings.HASH_CACHE_PATH
+  if not path or not _HASH_CACHE_PENDING:
+    return
+
+  try:
+    dirname = os.path.dirname(path)
+    if dirname:
+      os.makedirs(dirname, exist_ok=True)
+
+    with closing(sqlite3.connect(path)) as connection:
+      with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS hashes"
+            " (key TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+        connection.executemany(
+            "INSERT OR REPLACE INTO hashes (key, digest) VALUES (?, ?)",
+            [(json.dumps(key), digest)
+            for key, digest in _HASH_CACHE_PENDING.items()])
+        # Replaced rows get a new rowid, keep the most recently persisted ones
+        connection.execute("DELETE FROM hashes WHERE rowid NOT IN"
+            " (SELECT rowid FROM hashes ORDER BY rowid DESC LIMIT ?)",
+            (_HASH_CACHE_MAX_ENTRIES,))
+
+  except (OSError, sqlite3.Error) as e:
+    LOG.warning("Could not persist hash cache '{}': {}".format(path, e))
+    return
+
+  _HASH_CACHE_PENDING.clear()
+
+
+atexit.register(_persist_hash_cache)
+
+
+def _open_artifact(filepath):
+  """Internal helper that opens the passed file for unbuffered binary reading,
+  without updating its access time where supported (Linux), which saves the
+  inode write. Falls back to a regular open, if the current user does not own
+  the file, which O_NOATIME requires. """
+  flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+  noatime = getattr(os, "O_NOATIME", 0)
+
+  fd = None
+  if noatime:
+    try:
+      fd = os.open(filepath, flags | noatime)
+    except PermissionError:
+      pass
+
+  if fd is None:
+    fd = os.open(filepath, flags)
 
+  try:
+    return os.fdopen(fd, "rb", buffering=0)
+
+  except BaseException:
+    os.close(fd)
+    raise
 
 
+def _prefetch_artifact(filepath):
+  """Internal helper that opens the passed file and advises the kernel to
+  start reading its first _HASH_PREFETCH_SIZE bytes. Returns the opened file,
+  or None if it cannot be opened, which is reported when it is hashed. """
+  try:
+    file_object = _open_artifact(filepath)
+  except OSError:
+    return None
+
+  try:
+    os.posix_fadvise(file_object.fileno(), 0, _HASH_PREFETCH_SIZE,
+        os.POSIX_FADV_WILLNEED)
+  except OSError: # pragma: no cover
+    pass
+
+  return file_object
+
+
+def _iter_prefetched(filepaths):
+  """Internal helper that yields each passed filepath with its opened file
+  (see _prefetch_artifact), opening up to _HASH_PREFETCH_FILES files ahead,
+  so that they are read while the current one is hashed. Yields None for the
+  files, if the platform does not support posix_fadvise. Files, which were
+  opened but not yet yielded, are closed, when the generator is closed. """
+  if not hasattr(os, "posix_fadvise"): # pragma: no cover
+    for filepath in filepaths:
+      yield filepath, None
+    return
+
+  pending = collections.deque()
+  try:
+    for filepath in filepaths:
+      pending.append((filepath, _prefetch_artifact(filepath)))
+      if len(pending) > _HASH_PREFETCH_FILES:
+        yield pending.popleft()
+
+    while pending:
+      yield pending.popleft()
+
+  finally:
+    for _, file_object in pending:
+      if file_object is not None:
+        file_object.close()
+
 
 def _hash_artifact(filepath, hash_algorithms=None,
-      normalize_line_endings=False):
+      normalize_line_endings=False, cache_hits=None, local_cache=None,
+      file_object=None, max_workers=1):
   """Internal helper that takes a filename and hashes the respective file's
   contents using the passed hash_algorithms and returns a hashdict conformant
-  with securesystemslib.formats.HASHDICT_SCHEMA. """
+  with securesystemslib.formats.HASHDICT_SCHEMA.
+
+  If the HASH_CACHE_ENABLED setting is True, hashes are looked up in and added
+  to a bounded in-memory cache keyed by the identity (device and inode), size
+  and modification and change times of the file, so that unchanged files are
+  not read again, e.g. when they are recorded as materials and as products. If
+  the HASH_CACHE_PATH setting is set, the cache is also loaded from and
+  persisted at that path. The cache is not used on Windows. If a list is
+  passed as cache_hits, filepath is appended to it, if all hashes were found
+  in the cache.
+
+  If a dict is passed as local_cache, hashes are also looked up in and added
+  to it with the same keys, regardless of the setting and of recent changes,
+  e.g. to read hard links to the same file only once per recording.
+
+  If file_object is passed, it is read and closed, instead of opening
+  filepath. Large files are hashed with up to max_workers threads (see
+  `_digest_file_object`).
+
+  NOTE: hash_algorithms are expected to be validated by the caller (see
+  `record_artifacts_as_dict`), which avoids validating them for every file.
+  """
   if not hash_algorithms:
     hash_algorithms = ['sha256']
 
-  securesystemslib.formats.HASHALGORITHMS_SCHEMA.check_match(hash_algorithms)
   hash_dict = {}
 
-  for algorithm in hash_algorithms:
-    digest_object = securesystemslib.hash.digest_filename(filepath, algorithm,
-        normalize_line_endings=normalize_line_endings)
-    hash_dict.update({algorithm: digest_object.hexdigest()})
-
-  securesystemslib.formats.HASHDICT_SCHEMA.check_match(hash_dict)
+  try:
+    if file_object is None:
+      file_object = _open_artifact(filepath)
+
+    with file_object:
+      cache_key = None
+      file_size = None
+      file_stat = None
+      hashed_at = None
+      cache_enabled = _hash_cache_enabled()
+      if cache_enabled or local_cache is not None:
+        if cache_enabled and in_toto.settings.HASH_CACHE_PATH:
+          _load_hash_cache(in_toto.settings.HASH_CACHE_PATH)
+
+        # Stat the opened file, instead of the path, so that the key belongs
+        # to the contents that are actually read
+        file_stat = os.fstat(file_object.fileno())
+        file_size = file_stat.st_size
+        hashed_at = time.time_ns()
+        cache_key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+            file_stat.st_mtime_ns, file_stat.st_ctime_ns,
+            normalize_line_endings)
+
+        for algorithm in hash_algorithms:
+          digest = None
+          if cache_enabled:
+            digest = _HASH_CACHE.get(cache_key + (algorithm,))
+          if not digest and local_cache is not None:
+            digest = local_cache.get(cache_key + (algorithm,))
+          if digest:
+            hash_dict[algorithm] = digest
+
+      missing_algorithms = [algorithm for algorithm in hash_algorithms
+          if algorithm not in hash_dict]
+
+      if not missing_algorithms:
+        if cache_hits is not None:
+          cache_hits.append(filepath)
+
+      else:
+        hash_dict.update(_digest_file_object(file_object, missing_algorithms,
+            normalize_line_endings=normalize_line_endings,
+            file_size=file_size, max_workers=max_workers))
+
+        if local_cache is not None:
+          for algorithm in missing_algorithms:
+            local_cache[cache_key + (algorithm,)] = hash_dict[algorithm]
+
+        # Don't cache hashes of files that were changed too recently, to not
+        # miss a later change within the granularity of the file system's
+        # timestamps (cf. "racy git")
+        if cache_enabled and max(file_stat.st_mtime_ns,
+            file_stat.st_ctime_ns) < hashed_at - _HASH_CACHE_RACY_NS:
+          for algorithm in missing_algorithms:
+            _add_to_hash_cache(cache_key + (algorithm,), hash_dict[algorithm])
+
+  except OSError as e:
+    raise securesystemslib.exceptions.StorageError(
+        "Can't open {}".format(filepath)) from e
 
   return hash_dict
 
 
-def _apply_exclude_patterns(names, exclude_filter):
+@functools.lru_cache(maxsize=32)
+def _compile_exclude_patterns(exclude_patterns):
+  """Compile the passed tuple of gitignore-style patterns once per distinct
+  tuple, e.g. once for both materials and products of a step. """
+  return PathSpec.from_lines('gitwildmatch', exclude_patterns)
+
+
+def _apply_exclude_patterns(names, exclude_patterns):
   """Exclude matched patterns from passed names."""
   included = set(names)
 
-  # Assume old way for easier testing
-  if hasattr(exclude_filter, '__iter__'):
-    exclude_filter = PathSpec.from_lines('gitwildmatch', exclude_filter)
-
-  for excluded in exclude_filter.match_files(names):
+  for excluded in _compile_exclude_patterns(
+      tuple(exclude_patterns)).match_files(names):
     included.discard(excluded)
 
   return sorted(included)
 
 
-def _apply_left_strip(artifact_filepath, artifacts_dict, lstrip_paths=None):
+def _apply_left_strip(artifact_filepath, artifacts_dict, lstrip_filter=None):
   """ Internal helper function to left strip dictionary keys based on
-  prefixes passed by the user. """
-  if lstrip_paths:
+  prefixes passed by the user, compiled into a regular expression (see
+  `_compile_lstrip_paths`). """
+  if lstrip_filter:
     # If a prefix is passed using the argument --lstrip-paths,
     # that prefix is left stripped from the filepath passed.
     # Note: if the prefix doesn't include a trailing /, the dictionary key
     # may include an unexpected /.
-    for prefix in lstrip_paths:
-      if artifact_filepath.startswith(prefix):
-        artifact_filepath = artifact_filepath[len(prefix):]
-        break
+    match = lstrip_filter.match(artifact_filepath)
+    if match:
+      artifact_filepath = artifact_filepath[match.end():]
 
     if artifact_filepath in artifacts_dict:
       raise in_toto.exceptions.PrefixError("Prefix selection has "
@@ -118,9 +622,114 @@ def _apply_left_strip(artifact_filepath, artifacts_dict, lstrip_paths=None):
   return artifact_filepath
 
 
+def _compile_lstrip_paths(lstrip_paths):
+  """Internal helper to compile the passed left strip prefixes into a single
+  regular expression that matches the longest prefix at the start of a path,
+  so that each path is matched once instead of once per prefix. """
+  return re.compile("|".join(re.escape(prefix)
+      for prefix in sorted(lstrip_paths, key=len, reverse=True)))
+
+
+def _walk_files(top, exclude_patterns=None, follow_symlink_dirs=False):
+  """Internal helper that traverses the tree of the passed (normalized)
+  directory path and yields the paths of all files that are not excluded by
+  the passed exclude_patterns.
+
+  Uses `os.scandir`, whose directory entries cache the file type, and builds
+  paths relative to top by concatenation, which avoids additional stat and
+  path normalization calls per entry. """
+  # Directory paths are normalized, the current directory is not prefixed
+  if top == os.curdir:
+    top = ""
+
+  elif not top.endswith(("/", os.sep)):
+    top += "/"
+
+  stack = [top]
+  while stack:
+    root = stack.pop()
+    try:
+      with os.scandir(root or os.curdir) as entries:
+        dirpaths = []
+        filepaths = []
+        for entry in entries:
+          path = root + entry.name
+          try:
+            is_dir = entry.is_dir()
+          except OSError:
+            is_dir = False
+
+          if is_dir:
+            # Only recurse into symlinked dirs if we follow them
+            if follow_symlink_dirs or not entry.is_symlink():
+              dirpaths.append(path)
+
+          # Directory entries could also be dead symlinks, which would
+          # result in an error later when trying to read the file
+          elif entry.is_file():
+            filepaths.append(path)
+
+          else:
+            LOG.info("File '{}' appears to be a broken symlink. Skipping..."
+                .format(path))
+
+    # Unreadable directories are skipped, like `os.walk` does by default
+    except OSError:
+      continue
+
+    # Applying exclude patterns on the directory paths allows to exclude a
+    # subdirectory 'sub' with a pattern 'sub'. If we only applied the patterns
+    # on the subdirectory's containing file paths, we'd have to use a
+    # wildcard, e.g.: 'sub*'
+    if exclude_patterns:
+      dirpaths = _apply_exclude_patterns(dirpaths, exclude_patterns)
+      filepaths = _apply_exclude_patterns(filepaths, exclude_patterns)
+
+    yield from filepaths
+
+    # Push in reverse order to traverse subdirectories in listed order
+    for dirpath in reversed(dirpaths):
+      stack.append(dirpath + "/")
+
+
+def _group_by_directory(filepaths, max_group_size):
+  """Internal helper that splits the passed list of file paths, sorted by
+  directory, into consecutive groups of files in the same directory, with at
+  most max_group_size files each, so that large directories are still hashed
+  by multiple workers. """
+  for _, group in itertools.groupby(filepaths, key=os.path.dirname):
+    group = list(group)
+    for start in range(0, len(group), max_group_size):
+      yield group[start:start + max_group_size]
+
+
+def _init_hash_worker():
+  """Internal helper to initialize a worker process for hashing artifacts,
+  which does not use the hash cache, whose entries would be lost with the
+  worker. """
+  in_toto.settings.HASH_CACHE_ENABLED = False
+
+
+def _new_process_pool(max_workers):
+  """Internal helper that returns a process pool executor for hashing
+  artifacts, which starts worker processes with the platform default start
+  method. If that is "fork", callers must not run other threads at the time
+  (see _forks_hash_workers). """
+  return ProcessPoolExecutor(max_workers=max_workers,
+      initializer=_init_hash_worker)
+
+
+def _forks_hash_workers(normalize_line_endings):
+  """Internal helper that returns whether record_artifacts_as_dict may hash
+  artifacts in worker processes forked from the current process, with the
+  passed argument and current settings. """
+  return (normalize_line_endings and in_toto.settings.HASH_POOL == "process"
+      and multiprocessing.get_start_method() == "fork")
+
+
 def record_artifacts_as_dict(artifacts, exclude_patterns=None,
     base_path=None, follow_symlink_dirs=False, normalize_line_endings=False,
-    lstrip_paths=None):
+    lstrip_paths=None, hash_workers=None, hash_algorithms=None):
   """
   <Purpose>
     Hashes each file in the passed path list. If the path list contains
@@ -187,13 +796,32 @@ def record_artifacts_as_dict(artifacts, exclude_patterns=None,
             If a prefix path is passed, the prefix is left stripped from
             the path of every artifact that contains the prefix.
 
+    hash_workers: (optional)
+            The number of worker threads used to hash files in parallel.
+            If not passed, the HASH_WORKERS setting (see `in_toto.settings`)
+            or the number of CPUs is used. If 1, files are hashed serially.
+            A single file is hashed with this many threads, if the hash
+            algorithm supports it, e.g. "sha256-tree-1m" or "blake3".
+            See the HASH_POOL setting for using worker processes instead.
+
+    hash_algorithms: (optional)
+            A list of hash algorithms used to hash each file. The format is
+            in_toto.formats.HASH_ALGORITHMS_SCHEMA, i.e. any algorithm
+            supported by securesystemslib, a block-wise tree hash
+            algorithm, e.g. "sha256-tree-1m" (see TREE_HASH_ALGORITHMS), or
+            "blake3", if the optional blake3 package is installed.
+            If not passed, "sha256" is used.
+
   <Exceptions>
     in_toto.exceptions.ValueError,
-        if we cannot change to base path directory
+        if we cannot change to base path directory, or if the HASH_POOL
+        setting is not one of HASH_POOLS
 
     in_toto.exceptions.FormatError,
         if the list of exlcude patterns does not match format
-        securesystemslib.formats.NAMES_SCHEMA
+        securesystemslib.formats.NAMES_SCHEMA, or if the list of hash
+        algorithms does not match format
+        in_toto.formats.HASH_ALGORITHMS_SCHEMA
 
   <Side Effects>
     Calls functions to generate cryptographic hashes.
@@ -204,6 +832,17 @@ def record_artifacts_as_dict(artifacts, exclude_patterns=None,
 
   artifacts_dict = {}
 
+  # Validate hash algorithms once for all files
+  if not hash_algorithms:
+    hash_algorithms = ['sha256']
+
+  in_toto.formats.HASH_ALGORITHMS_SCHEMA.check_match(hash_algorithms)
+
+  if in_toto.settings.HASH_POOL not in HASH_POOLS:
+    raise ValueError("HASH_POOL setting must be one of {}, got '{}'".format(
+        ", ".join("'{}'".format(pool) for pool in HASH_POOLS),
+        in_toto.settings.HASH_POOL))
+
   if not artifacts:
     return artifacts_dict
 
@@ -237,9 +876,11 @@ def record_artifacts_as_dict(artifacts, exclude_patterns=None,
     # TODO: Do we want to keep the exclude pattern setting?
     exclude_patterns = in_toto.settings.ARTIFACT_EXCLUDE_PATTERNS
 
-  # Apply exclude patterns on the passed artifact paths if available
+  # Apply the gitignore-style patterns on the passed artifact paths and on all
+  # traversed paths if available, using a hashable tuple for memoization
   if exclude_patterns:
     securesystemslib.formats.NAMES_SCHEMA.check_match(exclude_patterns)
+    exclude_patterns = tuple(exclude_patterns)
     norm_artifacts = _apply_exclude_patterns(norm_artifacts, exclude_patterns)
 
   # Check if any of the prefixes passed for left stripping is a left substring
@@ -251,76 +892,117 @@ def record_artifacts_as_dict(artifacts, exclude_patterns=None,
         raise in_toto.exceptions.PrefixError("'{}' and '{}' "
             "triggered a left substring error".format(prefix_one, prefix_two))
 
-  # Compile the gitignore-style patterns
-  exclude_filter = PathSpec.from_lines('gitwildmatch', exclude_patterns or [])
+  lstrip_filter = None
+  if lstrip_paths:
+    lstrip_filter = _compile_lstrip_paths(lstrip_paths)
+
+  # Collect the paths of all files to record, mapped by their (left stripped)
+  # dictionary keys, before hashing any of them
+  artifact_paths = {}
 
   # Iterate over remaining normalized artifact paths
   for artifact in norm_artifacts:
-    if os.path.isfile(artifact):
+    # Stat each path only once, following symlinks like os.path.isfile/isdir
+    try:
+      artifact_mode = os.stat(artifact).st_mode
+    except (OSError, ValueError):
+      artifact_mode = 0
+
+    if stat.S_ISREG(artifact_mode):
       # FIXME: this is necessary to provide consisency between windows
       # filepaths and *nix filepaths. A better solution may be in order
       # though...
       artifact = artifact.replace('\\', '/')
-      key = _apply_left_strip(artifact, artifacts_dict, lstrip_paths)
-      artifacts_dict[key] = _hash_artifact(artifact,
-          normalize_line_endings=normalize_line_endings)
-
-    elif os.path.isdir(artifact):
-      for root, dirs, files in os.walk(artifact,
-          followlinks=follow_symlink_dirs):
-        # Create a list of normalized dirpaths
-        dirpaths = []
-        for dirname in dirs:
-          norm_dirpath = os.path.normpath(os.path.join(root, dirname))
-          dirpaths.append(norm_dirpath)
-
-        # Applying exclude patterns on the directory paths returned by walk
-        # allows to exclude a subdirectory 'sub' with a pattern 'sub'.
-        # If we only applied the patterns below on the subdirectory's
-        # containing file paths, we'd have to use a wildcard, e.g.: 'sub*'
-        if exclude_patterns:
-          dirpaths = _apply_exclude_patterns(dirpaths, exclude_filter)
-
-        # Reset and refill dirs with remaining names after exclusion
-        # Modify (not reassign) dirnames to only recurse into remaining dirs
-        dirs[:] = []
-        for dirpath in dirpaths:
-          # Dirs only contain the basename and not the full path
-          name = os.path.basename(dirpath)
-          dirs.append(name)
-
-        # Create a list of normalized filepaths
-        filepaths = []
-        for filename in files:
-          norm_filepath = os.path.normpath(os.path.join(root, filename))
-
-          # `os.walk` could also list dead symlinks, which would
-          # result in an error later when trying to read the file
-          if os.path.isfile(norm_filepath):
-            filepaths.append(norm_filepath)
-
-          else:
-            LOG.info("File '{}' appears to be a broken symlink. Skipping..."
-                .format(norm_filepath))
-
-        # Apply exlcude patterns on the normalized file paths returned by walk
-        if exclude_patterns:
-          filepaths = _apply_exclude_patterns(filepaths, exclude_filter)
-
-        for filepath in filepaths:
-          # FIXME: this is necessary to provide consisency between windows
-          # filepaths and *nix filepaths. A better solution may be in order
-          # though...
-          normalized_filepath = filepath.replace("\\", "/")
-          key = _apply_left_strip(
-              normalized_filepath, artifacts_dict, lstrip_paths)
-          artifacts_dict[key] = _hash_artifact(filepath,
-              normalize_line_endings=normalize_line_endings)
+      key = _apply_left_strip(artifact, artifact_paths, lstrip_filter)
+      artifact_paths[key] = artifact
+
+    elif stat.S_ISDIR(artifact_mode):
+      for filepath in _walk_files(artifact, exclude_patterns,
+          follow_symlink_dirs):
+        # FIXME: this is necessary to provide consisency between windows
+        # filepaths and *nix filepaths. A better solution may be in order
+        # though...
+        normalized_filepath = filepath.replace("\\", "/")
+        key = _apply_left_strip(
+            normalized_filepath, artifact_paths, lstrip_filter)
+        artifact_paths[key] = filepath
 
     # Path is no file and no directory
     else:
       LOG.info("path: {} does not exist, skipping..".format(artifact))
 
+  # Hash collected files, using a pool of worker threads if more than one
+  # worker is configured. Hashing releases the GIL while reading and digesting
+  # file contents, so that threads can overlap I/O and hashing across cores.
+  # Worker processes are used instead, if configured (see `HASH_POOL`).
+  if hash_workers is None:
+    hash_workers = in_toto.settings.HASH_WORKERS or os.cpu_count() or 1
+
+  # Hash files in directory order, so that files of the same directory are
+  # opened one after another, which keeps dentry and page caches warm
+  sorted_paths = sorted(artifact_paths.items(),
+      key=lambda item: os.path.split(item[1]))
+  # Hash each file only once, even if recorded under multiple keys, e.g. with
+  # different left stripped prefixes
+  filepaths = list(dict.fromkeys(filepath for _, filepath in sorted_paths))
+
+  # Files that were not changed since they were last hashed, e.g. as
+  # materials of the same step, are served from the hash cache, and files
+  # with the same identity, e.g. hard links, are read only once per call
+  cache_hits = []
+  local_cache = {}
+
+  def _hash(filepath, file_object=None):
+    return _hash_artifact(filepath, hash_algorithms=hash_algorithms,
+        normalize_line_endings=normalize_line_endings, cache_hits=cache_hits,
+        local_cache=local_cache, file_object=file_object,
+        max_workers=block_workers)
+
+  # Each file is opened, and starts being read, while the files before it are
+  # hashed
+  def _hash_group(group):
+    with closing(_iter_prefetched(group)) as prefetched:
+      return [_hash(filepath, file_object)
+          for filepath, file_object in prefetched]
+
+  # A single (large) file is hashed by the workers block-wise instead, if the
+  # algorithm supports it, which does not nest pools of workers per file
+  block_workers = hash_workers if len(filepaths) == 1 else 1
+
+  # Starting a pool costs more than it saves for a single file, and at most
+  # one worker per file is useful
+  hash_workers = min(hash_workers, len(filepaths))
+
+  # Normalizing line endings holds the GIL, use processes if configured
+  use_processes = (hash_workers > 1 and normalize_line_endings
+      and in_toto.settings.HASH_POOL == "process")
+
+  # Workers may not start in the current working directory, e.g. if started
+  # by a fork server, so they get absolute paths
+  if use_processes:
+    with _new_process_pool(hash_workers) as executor:
+      hash_dicts = list(executor.map(_hash_artifact,
+          [os.path.abspath(filepath) for filepath in filepaths],
+          itertools.repeat(hash_algorithms),
+          itertools.repeat(normalize_line_endings),
+          chunksize=_HASH_PROCESS_CHUNKSIZE))
+
+  # Each thread hashes (parts of) one directory at a time
+  elif hash_workers > 1:
+    with ThreadPoolExecutor(max_workers=hash_workers) as executor:
+      hash_dicts = list(itertools.chain.from_iterable(executor.map(
+          _hash_group, _group_by_directory(filepaths, _HASH_GROUP_SIZE))))
+
+  else:
+    hash_dicts = _hash_group(filepaths)
+
+  hash_dicts = dict(zip(filepaths, hash_dicts))
+  artifacts_dict = {key: dict(hash_dicts[filepath])
+      for key, filepath in sorted_paths}
+
+  if _hash_cache_enabled() and filepaths and not use_processes:
+    LOG.info("Reused cached hashes for {} of {} artifacts...".format(
+        len(cache_hits), len(filepaths)))
 
   # Change back to where original current working dir
   if base_path:
@@ -328,6 +1010,16 @@ def record_artifacts_as_dict(artifacts, exclude_patterns=None,
 
   return artifacts_dict
 
+
+# Maximum number of bytes read from a child process standard stream at once
+_STREAM_READ_SIZE = 65536
+
+# Maximum number of seconds between checks, if a child process has exited,
+# while waiting for its standard streams, e.g. if a background process holds
+# them open
+_STREAM_POLL_INTERVAL = 0.05
+
+
 def _subprocess_run_duplicate_streams(cmd, timeout):
   """Helper to run subprocess and both print and capture standards streams.
 
@@ -335,6 +1027,100 @@ def _subprocess_run_duplicate_streams(cmd, timeout):
   * Might behave unexpectedly with interactive commands.
   * Might not duplicate output in real time, if the command buffers it (see
     e.g. `print("foo")` vs. `print("foo", flush=True)`).
+
+  """
+  # Selectors don't support pipes on Windows, where we poll temporary files
+  if sys.platform == "win32": # pragma: no cover
+    return _subprocess_run_duplicate_streams_tempfile(cmd, timeout)
+
+  deadline = None
+  if timeout is not None:
+    deadline = time.monotonic() + timeout
+
+  proc = subprocess.Popen(  # pylint: disable=consider-using-with  # nosec
+    cmd,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    bufsize=0,
+  )
+  stdout_parts, stderr_parts = [], []
+  try:
+    with selectors.DefaultSelector() as selector:
+      # Decode child process output like `universal_newlines=True` would
+      encoding = locale.getpreferredencoding(False)
+      for pipe, stream, stream_parts in (
+          (proc.stdout, sys.stdout, stdout_parts),
+          (proc.stderr, sys.stderr, stderr_parts)):
+        os.set_blocking(pipe.fileno(), False)
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding)(), translate=True)
+        selector.register(pipe, selectors.EVENT_READ,
+            (stream, decoder, stream_parts))
+
+      def _duplicate(key, data):
+        """Decodes, writes and captures data read from a stream, which ends
+        if data is empty. """
+        stream, decoder, stream_parts = key.data
+        if not data:
+          selector.unregister(key.fileobj)
+        text = decoder.decode(data, final=not data)
+        if text:
+          stream.write(text)
+          stream.flush()
+          stream_parts.append(text)
+
+      # Duplicate streams whenever there is output, until both reach EOF or
+      # the process exits, whichever comes first
+      while selector.get_map() and proc.poll() is None:
+        remaining = _STREAM_POLL_INTERVAL
+        if deadline is not None:
+          remaining = deadline - time.monotonic()
+          # Time out as Python's `subprocess.run` would do it
+          if remaining <= 0:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+          remaining = min(remaining, _STREAM_POLL_INTERVAL)
+
+        for key, _ in selector.select(remaining):
+          try:
+            data = os.read(key.fd, _STREAM_READ_SIZE)
+          except BlockingIOError:
+            continue
+          _duplicate(key, data)
+
+      # Read what the process wrote between our last read and exiting, without
+      # waiting for EOF, e.g. if it left a background process holding a stream
+      for key in list(selector.get_map().values()):
+        data = True
+        while data:
+          try:
+            data = os.read(key.fd, _STREAM_READ_SIZE)
+          except BlockingIOError:
+            data = b""
+          _duplicate(key, data)
+
+      remaining = None
+      if deadline is not None:
+        remaining = max(deadline - time.monotonic(), 0)
+      proc.wait(timeout=remaining)
+
+  except BaseException:
+    proc.kill()
+    proc.wait()
+    raise
+
+  finally:
+    proc.stdout.close()
+    proc.stderr.close()
+
+  # Return process exit code and captured streams
+  return proc.returncode, "".join(stdout_parts), "".join(stderr_parts)
+
+
+def _subprocess_run_duplicate_streams_tempfile(cmd, timeout):
+  """Fallback for _subprocess_run_duplicate_streams on platforms without
+  selector support for pipes, which polls temporary files instead.
+
+  Caveat:
   * Possible race condition on Windows when removing temporary files.
 
   """
@@ -355,7 +1141,7 @@ def _subprocess_run_duplicate_streams(cmd, timeout):
     ) as stderr_writer:
 
       # Store stream results in mutable dict to update it inside nested helper
-      _std = {"out": "", "err": ""}
+      _std = {"out": [], "err": []}
 
       def _duplicate_streams():
         """Helper to read from child process standard streams, write their
@@ -371,8 +1157,9 @@ def _subprocess_run_duplicate_streams(cmd, timeout):
         sys.stderr.write(stderr_part)
         sys.stdout.flush()
         sys.stderr.flush()
-        _std["out"] += stdout_part
-        _std["err"] += stderr_part
+        _std["out"].append(stdout_part)
+        _std["err"].append(stderr_part)
+        return stdout_part or stderr_part
 
       # Start child process, writing its standard streams to temporary files
       proc = subprocess.Popen(  # pylint: disable=consider-using-with  # nosec
@@ -396,9 +1183,10 @@ def _subprocess_run_duplicate_streams(cmd, timeout):
 
         _duplicate_streams()
 
-      # Read/write once more to grab everything that the process wrote between
+      # Read/write until EOF to grab everything that the process wrote between
       # our last read in the loop and exiting, i.e. breaking the loop.
-      _duplicate_streams()
+      while _duplicate_streams():
+        pass
 
   finally:
     # The work is done or was interrupted, the temp files can be removed
@@ -406,7 +1194,7 @@ def _subprocess_run_duplicate_streams(cmd, timeout):
     os.remove(stderr_name)
 
   # Return process exit code and captured streams
-  return proc.poll(), _std["out"], _std["err"]
+  return proc.poll(), "".join(_std["out"]), "".join(_std["err"])
 
 def execute_link(link_cmd_args, record_streams):
   """
@@ -421,9 +1209,10 @@ def execute_link(link_cmd_args, record_streams):
             A list where the first element is a command and the remaining
             elements are arguments passed to that command.
     record_streams:
-            A bool that specifies whether to redirect standard output and
-            and standard error to a temporary file which is returned to the
-            caller (True) or not (False).
+            A bool that specifies whether to record standard output and
+            and standard error, which are returned to the caller (True) or
+            not (False). Recorded streams are also written to the standard
+            streams of the caller, while the command runs.
 
   <Exceptions>
     OSError:
@@ -502,6 +1291,13 @@ def in_toto_mock(name, link_cmd_args, use_dsse=False):
   return link_metadata
 
 
+def _get_workdir():
+  """Helper to return the current working directory with forward slashes, as
+  recorded in the environment of link metadata. The result is not cached,
+  because the working directory may change between calls. """
+  return os.getcwd().replace('\\', '/')
+
+
 def _check_match_signing_key(signing_key):
   """ Helper method to check if the signing_key has securesystemslib's
   KEY_SCHEMA and the private part is not empty.
@@ -513,12 +1309,50 @@ def _check_match_signing_key(signing_key):
         "Signing key needs to be a private key.")
 
 
+def _validate_run_args(signing_key=None, gpg_keyid=None,
+    exclude_patterns=None, base_path=None, metadata_directory=None,
+    link_cmd_args=None, product_list=None):
+  """Helper to check the formats of the arguments shared by in_toto_run,
+  in_toto_record_start and in_toto_record_stop once, before any work is done.
+  """
+  if signing_key:
+    _check_match_signing_key(signing_key)
+  if gpg_keyid:
+    securesystemslib.formats.KEYID_SCHEMA.check_match(gpg_keyid)
+
+  if exclude_patterns:
+    securesystemslib.formats.NAMES_SCHEMA.check_match(exclude_patterns)
+
+  if base_path:
+    securesystemslib.formats.PATH_SCHEMA.check_match(base_path)
+
+  if metadata_directory:
+    securesystemslib.formats.PATH_SCHEMA.check_match(metadata_directory)
+
+  if link_cmd_args:
+    securesystemslib.formats.LIST_OF_ANY_STRING_SCHEMA.check_match(
+        link_cmd_args)
+
+  if product_list:
+    securesystemslib.formats.PATHS_SCHEMA.check_match(product_list)
+
+
+def _get_signer(signing_key=None, gpg_keyid=None, gpg_home=None):
+  """Helper to return a signer for the passed signing key, or else for the
+  passed (or default, if None) gpg keyid from the keyring at gpg_home. """
+  if signing_key:
+    return SSlibSigner(signing_key)
+
+  return GPGSigner(keyid=gpg_keyid, homedir=gpg_home)
+
+
+
 def in_toto_run(name, material_list, product_list, link_cmd_args,
     record_streams=False, signing_key=None, gpg_keyid=None,
     gpg_use_default=False, gpg_home=None, exclude_patterns=None,
     base_path=None, compact_json=False, record_environment=False,
     normalize_line_endings=False, lstrip_paths=None, metadata_directory=None,
-    use_dsse=False):
+    use_dsse=False, hash_workers=None, durable_writes=False):
   """Performs a supply chain step or inspection generating link metadata.
 
   Executes link_cmd_args, recording paths and hashes of files before and after
@@ -582,6 +1416,14 @@ def in_toto_run(name, material_list, product_list, link_cmd_args,
     use_dsse (optional): A boolean indicating if DSSE should be used to
         generate metadata.
 
+    hash_workers (optional): The number of worker threads used to hash
+        artifacts in parallel. Default is the HASH_WORKERS setting or the
+        number of CPUs. If 1, artifacts are hashed serially.
+
+    durable_writes (optional): A boolean indicating if link metadata, and
+        the directory it is stored in under its final name, should be synced
+        to disk, to survive a system crash. Default is False.
+
   Raises:
     securesystemslib.exceptions.FormatError: Passed arguments are malformed.
 
@@ -616,20 +1458,11 @@ def in_toto_run(name, material_list, product_list, link_cmd_args,
   """
   LOG.info("Running '{}'...".format(name))
 
-  # Check key formats to fail early
-  if signing_key:
-    _check_match_signing_key(signing_key)
-  if gpg_keyid:
-    securesystemslib.formats.KEYID_SCHEMA.check_match(gpg_keyid)
-
-  if exclude_patterns:
-    securesystemslib.formats.NAMES_SCHEMA.check_match(exclude_patterns)
-
-  if base_path:
-    securesystemslib.formats.PATH_SCHEMA.check_match(base_path)
-
-  if metadata_directory:
-    securesystemslib.formats.PATH_SCHEMA.check_match(metadata_directory)
+  # Check key and argument formats to fail early
+  _validate_run_args(signing_key=signing_key, gpg_keyid=gpg_keyid,
+      exclude_patterns=exclude_patterns, base_path=base_path,
+      metadata_directory=metadata_directory, link_cmd_args=link_cmd_args,
+      product_list=product_list)
 
   if material_list:
     LOG.info("Recording materials '{}'...".format(", ".join(material_list)))
@@ -637,29 +1470,26 @@ def in_toto_run(name, material_list, product_list, link_cmd_args,
   materials_dict = record_artifacts_as_dict(material_list,
       exclude_patterns=exclude_patterns, base_path=base_path,
       follow_symlink_dirs=True, normalize_line_endings=normalize_line_endings,
-      lstrip_paths=lstrip_paths)
+      lstrip_paths=lstrip_paths, hash_workers=hash_workers)
 
   if link_cmd_args:
-    securesystemslib.formats.LIST_OF_ANY_STRING_SCHEMA.check_match(
-        link_cmd_args)
     LOG.info("Running command '{}'...".format(" ".join(link_cmd_args)))
     byproducts = execute_link(link_cmd_args, record_streams)
   else:
     byproducts = {}
 
   if product_list:
-    securesystemslib.formats.PATHS_SCHEMA.check_match(product_list)
     LOG.info("Recording products '{}'...".format(", ".join(product_list)))
 
   products_dict = record_artifacts_as_dict(product_list,
       exclude_patterns=exclude_patterns, base_path=base_path,
       follow_symlink_dirs=True, normalize_line_endings=normalize_line_endings,
-      lstrip_paths=lstrip_paths)
+      lstrip_paths=lstrip_paths, hash_workers=hash_workers)
 
   LOG.info("Creating link metadata...")
   environment = {}
   if record_environment:
-    environment['workdir'] = os.getcwd().replace('\\', '/')
+    environment['workdir'] = _get_workdir()
 
   link = in_toto.models.link.Link(name=name,
       materials=materials_dict, products=products_dict, command=link_cmd_args,
@@ -675,15 +1505,15 @@ def in_toto_run(name, material_list, product_list, link_cmd_args,
   signer = None
   if signing_key:
     LOG.info("Signing link metadata using passed key...")
-    signer = SSlibSigner(signing_key)
+    signer = _get_signer(signing_key=signing_key)
 
   elif gpg_keyid:
     LOG.info("Signing link metadata using passed GPG keyid...")
-    signer = GPGSigner(keyid=gpg_keyid, homedir=gpg_home)
+    signer = _get_signer(gpg_keyid=gpg_keyid, gpg_home=gpg_home)
 
   elif gpg_use_default:
     LOG.info("Signing link metadata using default GPG key ...")
-    signer = GPGSigner(keyid=None, homedir=gpg_home)
+    signer = _get_signer(gpg_home=gpg_home)
 
   # We need the signature's keyid to write the link to keyid infix'ed filename
   if signer:
@@ -696,7 +1526,7 @@ def in_toto_run(name, material_list, product_list, link_cmd_args,
       filename = os.path.join(metadata_directory, filename)
 
     LOG.info("Storing link metadata to '{}'...".format(filename))
-    link_metadata.dump(filename)
+    dump_atomic(link_metadata, filename, fsync=durable_writes)
 
   return link_metadata
 
@@ -704,7 +1534,8 @@ def in_toto_run(name, material_list, product_list, link_cmd_args,
 def in_toto_record_start(step_name, material_list, signing_key=None,
     gpg_keyid=None, gpg_use_default=False, gpg_home=None,
     exclude_patterns=None, base_path=None, record_environment=False,
-    normalize_line_endings=False, lstrip_paths=None, use_dsse=False):
+    normalize_line_endings=False, lstrip_paths=None, use_dsse=False,
+    hash_workers=None, durable_writes=False):
   """Generates preliminary link metadata.
 
   Records paths and hashes of materials in a preliminary link metadata file.
@@ -755,6 +1586,14 @@ def in_toto_record_start(step_name, material_list, signing_key=None,
     use_dsse (optional): A boolean indicating if DSSE should be used to
         generate metadata.
 
+    hash_workers (optional): The number of worker threads used to hash
+        artifacts in parallel. Default is the HASH_WORKERS setting or the
+        number of CPUs. If 1, artifacts are hashed serially.
+
+    durable_writes (optional): A boolean indicating if link metadata, and
+        the directory it is stored in under its final name, should be synced
+        to disk, to survive a system crash. Default is False.
+
   Raises:
     securesystemslib.exceptions.FormatError: Passed arguments are malformed.
 
@@ -791,17 +1630,9 @@ def in_toto_record_start(step_name, material_list, signing_key=None,
     raise ValueError("Pass either a signing key, a gpg keyid or set"
         " gpg_use_default to True!")
 
-  # Check key formats to fail early
-  if signing_key:
-    _check_match_signing_key(signing_key)
-  if gpg_keyid:
-    securesystemslib.formats.KEYID_SCHEMA.check_match(gpg_keyid)
-
-  if exclude_patterns:
-    securesystemslib.formats.NAMES_SCHEMA.check_match(exclude_patterns)
-
-  if base_path:
-    securesystemslib.formats.PATH_SCHEMA.check_match(base_path)
+  # Check key and argument formats to fail early
+  _validate_run_args(signing_key=signing_key, gpg_keyid=gpg_keyid,
+      exclude_patterns=exclude_patterns, base_path=base_path)
 
   if material_list:
     LOG.info("Recording materials '{}'...".format(", ".join(material_list)))
@@ -809,12 +1640,12 @@ def in_toto_record_start(step_name, material_list, signing_key=None,
   materials_dict = record_artifacts_as_dict(material_list,
       exclude_patterns=exclude_patterns, base_path=base_path,
       follow_symlink_dirs=True, normalize_line_endings=normalize_line_endings,
-      lstrip_paths=lstrip_paths)
+      lstrip_paths=lstrip_paths, hash_workers=hash_workers)
 
   LOG.info("Creating preliminary link metadata...")
   environment = {}
   if record_environment:
-    environment['workdir'] = os.getcwd().replace('\\', '/')
+    environment['workdir'] = _get_workdir()
 
   link = in_toto.models.link.Link(name=step_name,
           materials=materials_dict, products={}, command=[], byproducts={},
@@ -829,15 +1660,15 @@ def in_toto_record_start(step_name, material_list, signing_key=None,
 
   if signing_key:
     LOG.info("Signing link metadata using passed key...")
-    signer = SSlibSigner(signing_key)
+    signer = _get_signer(signing_key=signing_key)
 
   elif gpg_keyid:
     LOG.info("Signing link metadata using passed GPG keyid...")
-    signer = GPGSigner(keyid=gpg_keyid, homedir=gpg_home)
+    signer = _get_signer(gpg_keyid=gpg_keyid, gpg_home=gpg_home)
 
   else:  # (gpg_use_default)
     LOG.info("Signing link metadata using default GPG key ...")
-    signer = GPGSigner(keyid=None, homedir=gpg_home)
+    signer = _get_signer(gpg_home=gpg_home)
 
   signature = link_metadata.create_signature(signer)
   # We need the signature's keyid to write the link to keyid infix'ed filename
@@ -848,14 +1679,15 @@ def in_toto_record_start(step_name, material_list, signing_key=None,
 
   LOG.info(
       "Storing preliminary link metadata to '{}'...".format(unfinished_fn))
-  link_metadata.dump(unfinished_fn)
+  dump_atomic(link_metadata, unfinished_fn, fsync=durable_writes)
 
 
 
 def in_toto_record_stop(step_name, product_list, signing_key=None,
     gpg_keyid=None, gpg_use_default=False, gpg_home=None,
     exclude_patterns=None, base_path=None, normalize_line_endings=False,
-    lstrip_paths=None, metadata_directory=None):
+    lstrip_paths=None, metadata_directory=None, hash_workers=None,
+    durable_writes=False, skip_preliminary_verify=False):
   """Finalizes preliminary link metadata generated with in_toto_record_start.
 
   Loads preliminary link metadata file, verifies its signature, and records
@@ -904,6 +1736,22 @@ def in_toto_record_stop(step_name, product_list, signing_key=None,
     metadata_directory (optional): A directory path to write the resulting link
         metadata file to. Default destination is the current working directory.
 
+    hash_workers (optional): The number of worker threads used to hash
+        artifacts in parallel. Default is the HASH_WORKERS setting or the
+        number of CPUs. If 1, artifacts are hashed serially.
+
+    durable_writes (optional): A boolean indicating if link metadata, and
+        the directory it is stored in under its final name, should be synced
+        to disk, to survive a system crash. Default is False.
+
+    skip_preliminary_verify (optional): A boolean indicating if verifying the
+        signature of the preliminary link metadata with the passed signing_key
+        should be skipped, checking only that it has a signature with the
+        same keyid. Only use this, if nobody else can write the preliminary
+        link metadata file between start and stop, e.g. in a single CI job,
+        because its contents are signed as they are found. Has no effect if
+        signing with a gpg key. Default is False.
+
   Raises:
     securesystemslib.exceptions.FormatError: Passed arguments are malformed.
 
@@ -912,6 +1760,9 @@ def in_toto_record_stop(step_name, product_list, signing_key=None,
 
     LinkNotFoundError: No preliminary link metadata file found.
 
+    SignatureVerificationError: The preliminary link metadata file is not
+        signed with the passed key.
+
     securesystemslib.exceptions.StorageError: Cannot hash artifacts.
 
     PrefixError: Left-stripping artifact paths results in non-unique dict keys.
@@ -944,19 +1795,9 @@ def in_toto_record_stop(step_name, product_list, signing_key=None,
     raise ValueError("Pass either a signing key, a gpg keyid or set"
         " gpg_use_default to True")
 
-  if signing_key:
-    _check_match_signing_key(signing_key)
-  if gpg_keyid:
-    securesystemslib.formats.KEYID_SCHEMA.check_match(gpg_keyid)
-
-  if exclude_patterns:
-    securesystemslib.formats.NAMES_SCHEMA.check_match(exclude_patterns)
-
-  if base_path:
-    securesystemslib.formats.PATH_SCHEMA.check_match(base_path)
-
-  if metadata_directory:
-    securesystemslib.formats.PATH_SCHEMA.check_match(metadata_directory)
+  _validate_run_args(signing_key=signing_key, gpg_keyid=gpg_keyid,
+      exclude_patterns=exclude_patterns, base_path=base_path,
+      metadata_directory=metadata_directory)
 
   # Load preliminary link file
   # If we have a signing key we can use the keyid to construct the name
@@ -965,11 +1806,9 @@ def in_toto_record_stop(step_name, product_list, signing_key=None,
         keyid=signing_key["keyid"])
 
   # FIXME: Currently there is no way to know the default GPG key's keyid and
-  # so we glob for preliminary link files
+  # so we search for preliminary link files
   else:
-    unfinished_fn_glob = UNFINISHED_FILENAME_FORMAT_GLOB.format(
-        step_name=step_name, pattern="*")
-    unfinished_fn_list = glob.glob(unfinished_fn_glob)
+    unfinished_fn_list = find_unfinished(step_name)
 
     if not len(unfinished_fn_list):
       raise in_toto.exceptions.LinkNotFoundError("Could not find a preliminary"
@@ -984,72 +1823,54 @@ def in_toto_record_stop(step_name, product_list, signing_key=None,
 
     unfinished_fn = unfinished_fn_list[0]
 
-  LOG.info("Loading preliminary link metadata '{}'...".format(unfinished_fn))
-  link_metadata = Metadata.load(unfinished_fn)
+  # Load and verify the preliminary link, which may call gpg, in the
+  # background while products are hashed. Paths are made absolute, because
+  # recording artifacts temporarily changes into the base path.
+  unfinished_fn = os.path.abspath(unfinished_fn)
+  if gpg_home:
+    gpg_home = os.path.abspath(gpg_home)
 
-  # The file must have been signed by the same key
-  # If we have a signing_key we use it for verification as well
-  if signing_key:
-    LOG.info(
-        "Verifying preliminary link signature using passed signing key...")
-    keyid = signing_key["keyid"]
-    verification_key = signing_key
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    preliminary_link = executor.submit(load_preliminary_link, unfinished_fn,
+        signing_key=signing_key, gpg_keyid=gpg_keyid, gpg_home=gpg_home,
+        skip_verify=skip_preliminary_verify)
 
-  elif gpg_keyid:
-    LOG.info("Verifying preliminary link signature using passed gpg key...")
-    gpg_pubkey = securesystemslib.gpg.functions.export_pubkey(
-        gpg_keyid, gpg_home)
-    keyid = gpg_pubkey["keyid"]
-    verification_key = gpg_pubkey
-
-  else: # must be gpg_use_default
-    # FIXME: Currently there is no way to know the default GPG key's keyid
-    # before signing. As a workaround we extract the keyid of the preliminary
-    # Link file's signature and try to export a pubkey from the gpg
-    # home directory. We do this even if a gpg_keyid was specified, because gpg
-    # accepts many different ids (mail, name, parts of an id, ...) but we
-    # need a specific format.
-    LOG.info("Verifying preliminary link signature using default gpg key...")
-    # signatures are objects in DSSE.
-    sig = link_metadata.signatures[0]
-    if isinstance(sig, Signature):
-      keyid = sig.keyid
-    else:
-      keyid = sig["keyid"]
-    gpg_pubkey = securesystemslib.gpg.functions.export_pubkey(
-        keyid, gpg_home)
-    verification_key = gpg_pubkey
+    # Wait for the background thread to finish, before hash worker processes
+    # are forked, which is unsafe while other threads run
+    if _forks_hash_workers(normalize_line_endings):
+      executor.shutdown()
 
-  link_metadata.verify_signature(verification_key)
+    # Record products if a product path list was passed
+    if product_list:
+      LOG.info("Recording products '{}'...".format(", ".join(product_list)))
 
-  LOG.info("Extracting Link from metadata...")
-  link = link_metadata.get_payload()
+    products = record_artifacts_as_dict(
+        product_list, exclude_patterns=exclude_patterns, base_path=base_path,
+        follow_symlink_dirs=True,
+        normalize_line_endings=normalize_line_endings,
+        lstrip_paths=lstrip_paths, hash_workers=hash_workers)
 
-  # Record products if a product path list was passed
-  if product_list:
-    LOG.info("Recording products '{}'...".format(", ".join(product_list)))
+    link_metadata, keyid = preliminary_link.result()
 
-  link.products = record_artifacts_as_dict(
-      product_list, exclude_patterns=exclude_patterns, base_path=base_path,
-      follow_symlink_dirs=True, normalize_line_endings=normalize_line_endings,
-      lstrip_paths=lstrip_paths)
+  LOG.info("Extracting Link from metadata...")
+  link = link_metadata.get_payload()
+  link.products = products
 
-  if isinstance(link_metadata, Metablock):
-    LOG.info("Generating link metadata using Metablock...")
-    link_metadata = Metablock(signed=link)
-  else:
-    LOG.info("Generating link metadata using DSSE...")
-    link_metadata = Envelope.from_signable(link)
+  # Reuse the loaded Metablock or Envelope, with the updated link object as
+  # payload, and only drop the signature of the preliminary link
+  LOG.debug("Generating link metadata using {}...".format(
+      "Metablock" if isinstance(link_metadata, Metablock) else "DSSE"))
+  link_metadata.set_payload(link)
 
   if signing_key:
     LOG.info("Updating signature with key '{:.8}...'...".format(keyid))
-    signer = SSlibSigner(signing_key)
+    signer = _get_signer(signing_key=signing_key)
 
   else: # gpg_keyid or gpg_use_default
     # In both cases we use the keyid we got from verifying the preliminary
     # link signature above.
     LOG.info("Updating signature with gpg key '{:.8}...'...".format(keyid))
-    signer = GPGSigner(keyid=keyid, homedir=gpg_home)
+    signer = _get_signer(gpg_keyid=keyid, gpg_home=gpg_home)
 
   link_metadata.create_signature(signer)
   fn = FILENAME_FORMAT.format(step_name=step_name, keyid=keyid)
@@ -1057,8 +1878,4 @@ def in_toto_record_stop(step_name, product_list, signing_key=None,
   if metadata_directory is not None:
     fn = os.path.join(metadata_directory, fn)
 
-  LOG.info("Storing link metadata to '{}'...".format(fn))
-  link_metadata.dump(fn)
-
-  LOG.info("Removing unfinished link metadata '{}'...".format(unfinished_fn))
-  os.remove(unfinished_fn)
+  atomic_finalize(link_metadata, fn, unfinished_fn, fsync=durable_writes)
@@ -46,3 +46,34 @@ ARTIFACT_BASE_PATH = None
 
 # Max timeout for the in-toto-run command
 LINK_CMD_EXEC_TIMEOUT = 10
+
+# Max number of worker threads used to hash artifacts in parallel when
+# recording materials and products
+# If not set the number of CPUs on the host is used, a value of 1 hashes
+# artifacts serially
+HASH_WORKERS = None
+
+# Kind of worker pool used to hash artifacts in parallel, either "thread" or
+# "process", other values are rejected when recording artifacts
+# Threads scale across cores, because hashlib releases the GIL while hashing,
+# but normalizing line endings is done in Python and holds it. With "process",
+# artifacts whose line endings are normalized are hashed in worker processes
+# instead. Their hashes are not added to the in-memory hash cache.
+HASH_POOL = "thread"
+
+# Cache artifact hashes in memory, keyed by the identity, size and modification
+# and change times of a file, to skip re-hashing unchanged files, e.g. files
+# that are recorded as materials and again as products
+# Disabled by default, enable only if file metadata may be trusted to detect
+# changes, e.g. not for auditing. The cache is bounded and never used on
+# Windows, where the change time is the creation time of a file
+# NOTE: Paths of the same file, e.g. hard links, recorded in a single call are
+# read only once either way
+HASH_CACHE_ENABLED = False
+
+# Path to an SQLite database file to persist the artifact hash cache across
+# runs, e.g. `os.path.expanduser("~/.cache/in-toto/hashes.sqlite")`
+# If not set the hash cache is only kept in memory
+# WARNING: Hashes are loaded from the file as they are, anyone who can write
+# to it can make in-toto record any hash for an artifact
+HASH_CACHE_PATH = None
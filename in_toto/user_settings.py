@@ -58,10 +58,47 @@ RC_PATHS = [
 # TODO: Should we use `dir` on the module instead? If we list them here, we
 # have to manually update if `settings.py` changes.
 IN_TOTO_SETTINGS = [
-  "ARTIFACT_EXCLUDE_PATTERNS", "ARTIFACT_BASE_PATH", "LINK_CMD_EXEC_TIMEOUT"
+  "ARTIFACT_EXCLUDE_PATTERNS", "ARTIFACT_BASE_PATH", "LINK_CMD_EXEC_TIMEOUT",
+  "HASH_WORKERS", "HASH_POOL", "HASH_CACHE_ENABLED", "HASH_CACHE_PATH"
 ]
 
 
+def _parse_bool(value):
+  """ Return the boolean for a string value such as "true", "yes", "on" or
+  "1", and "false", "no", "off" or "0" (case insensitive). """
+  try:
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+  except (AttributeError, KeyError) as e:
+    raise ValueError("not a boolean: {!r}".format(value)) from e
+
+
+def _parse_positive_int(value):
+  """ Return the integer for a string value greater than zero. """
+  number = int(value)
+  if number < 1:
+    raise ValueError("not a positive integer: {!r}".format(value))
+
+  return number
+
+
+def _parse_path(value):
+  """ Return a path, joining a value that was split at colons. """
+  if isinstance(value, list):
+    return ":".join(value)
+
+  return value
+
+
+# Functions to parse the values of settings in IN_TOTO_SETTINGS, which are not
+# used as string (or list)
+SETTING_PARSERS = {
+  "HASH_WORKERS": _parse_positive_int,
+  "HASH_CACHE_ENABLED": _parse_bool,
+  "HASH_CACHE_PATH": _parse_path,
+}
+
+
 def _colon_split(value):
   """ If `value` contains colons, return a list split at colons,
   return value otherwise. """
@@ -194,6 +231,9 @@ def set_settings():
     and overrides variables in `settings.py` with the retrieved values, if they
     are whitelisted in `IN_TOTO_SETTINGS`.
 
+    Values of settings in `SETTING_PARSERS` are parsed, e.g. as boolean or
+    integer, and ignored with a warning, if they are invalid.
+
     Settings defined in RCfiles take precedence over settings defined in
     environment variables.
 
@@ -214,7 +254,16 @@ def set_settings():
   # IN_TOTO_SETTINGS per envvar or rcfile, override the item in `settings.py`
   for setting in IN_TOTO_SETTINGS:
     user_setting = user_settings.get(setting)
-    if user_setting:
+    if user_setting and setting in SETTING_PARSERS:
+      try:
+        user_setting = SETTING_PARSERS[setting](user_setting)
+
+      except (TypeError, ValueError) as e:
+        LOG.warning("Ignoring invalid setting (user): {0}={1} ({2})".format(
+            setting, user_setting, e))
+        user_setting = None
+
+    if user_setting is not None and user_setting != "":
       LOG.info("Setting (user): {0}={1}".format(
           setting, user_setting))
       setattr(in_toto.settings, setting, user_setting)
@@ -72,6 +72,21 @@ class TestMetablockValidator(unittest.TestCase, TmpDirMixin):
 
     self.assertIsInstance(link, Link)
 
+  def test_set_payload(self):
+    """Test replacing the envelope payload drops all signatures."""
+    env = Envelope.load(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "../demo_dsse_files", "package.2f89b927.link"))
+    self.assertTrue(env.signatures)
+
+    link = env.get_payload()
+    link.products = {"foo": {"sha256": "0" * 64}}
+    env.set_payload(link)
+
+    self.assertEqual(env.get_payload(), link)
+    self.assertEqual(env.payload, Envelope.from_signable(link).payload)
+    self.assertEqual(env.signatures, [])
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -21,10 +21,13 @@
 
 """
 
+import json
 import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
-from in_toto.models.metadata import Metablock
+from in_toto.models.metadata import Envelope, Metablock, Metadata
 from in_toto.models.layout import Layout
 from in_toto.models.link import Link
 from securesystemslib.exceptions import FormatError
@@ -86,5 +89,45 @@ class TestMetablockValidator(unittest.TestCase):
     metablock._validate_signatures()
 
 
+class TestMetadataLoad(unittest.TestCase):
+  """Test Metadata.load with and without the optional orjson package. """
+
+  def test_load_json_loads(self):
+    """Test loading metadata with the same result using either parser. """
+    demo_link_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+        "..", "demo_files", "write-code.776a00e2.link")
+
+    with patch("in_toto.models.metadata.orjson", None):
+      metadata = Metadata.load(demo_link_path)
+
+    # Any parser is passed the file contents as bytes
+    with patch("in_toto.models.metadata.orjson") as orjson:
+      orjson.loads.side_effect = json.loads
+      self.assertEqual(Metadata.load(demo_link_path).to_dict(),
+          metadata.to_dict())
+      self.assertIsInstance(orjson.loads.call_args.args[0], bytes)
+
+
+class TestMetadataToBytes(unittest.TestCase):
+  """Test Metadata.to_bytes, which returns what Metadata.dump writes. """
+
+  def test_to_bytes_like_dump(self):
+    """Test metadata is serialized to the same bytes as written by dump. """
+    link = Link(name="foo")
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      for metadata in [Metablock(signed=link),
+          Metablock(signed=link, compact_json=True),
+          Envelope.from_signable(link)]:
+        metadata.dump(path)
+        with open(path, "rb") as fp:
+          self.assertEqual(metadata.to_bytes(), fp.read())
+        self.assertEqual(Metadata.load(path).get_payload(), link)
+
+    finally:
+      os.remove(path)
+
+
 if __name__ == "__main__":
   unittest.main()
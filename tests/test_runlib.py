@@ -21,21 +21,26 @@
   Test runlib functions.
 
 """
+import hashlib
+import io
 import os
 import unittest
 import shutil
 import tempfile
+import threading
 import sys
 import stat
 import subprocess
+from unittest.mock import MagicMock, patch
 
 import in_toto.settings
 import in_toto.exceptions
-from in_toto.models.metadata import Envelope, Metablock
+import in_toto._link_files
+from in_toto.models.metadata import Envelope, Metablock, Metadata
 from in_toto.exceptions import SignatureVerificationError
 from in_toto.runlib import (in_toto_run, in_toto_record_start,
     in_toto_record_stop, record_artifacts_as_dict, _apply_exclude_patterns,
-    _hash_artifact, _subprocess_run_duplicate_streams)
+    _hash_artifact, _subprocess_run_duplicate_streams, _HASH_CHUNK_SIZE)
 from securesystemslib.interface import (
     generate_and_write_unencrypted_rsa_keypair,
     import_rsa_privatekey_from_file,
@@ -94,6 +99,16 @@ class Test_ApplyExcludePatterns(unittest.TestCase):
     result = _apply_exclude_patterns(names, patterns)
     self.assertListEqual(result, expected)
 
+  def test_apply_exclude_compiled_once(self):
+    names = ["foo", "bar", "baz"]
+    patterns = ["ba*"]
+    in_toto.runlib._compile_exclude_patterns.cache_clear()
+    self.assertListEqual(_apply_exclude_patterns(names, patterns), ["foo"])
+    self.assertListEqual(_apply_exclude_patterns(["bar", "qux"], patterns),
+        ["qux"])
+    self.assertEqual(
+        in_toto.runlib._compile_exclude_patterns.cache_info().misses, 1)
+
 
 class TestRecordArtifactsAsDict(unittest.TestCase, TmpDirMixin):
   """Test record_artifacts_as_dict(artifacts). """
@@ -333,6 +348,20 @@ class TestRecordArtifactsAsDict(unittest.TestCase, TmpDirMixin):
       os.unlink(pair[1])
 
 
+  def test_record_without_unreadable_dirs(self):
+    """Unreadable directories are skipped, like os.walk does. """
+    scandir = os.scandir
+
+    def _scandir(path):
+      if os.path.normpath(path) == os.path.join("subdir", "subsubdir"):
+        raise PermissionError
+      return scandir(path)
+
+    with patch("os.scandir", side_effect=_scandir):
+      artifacts_dict = record_artifacts_as_dict(["."])
+    self.assertIn("subdir/foosub1", artifacts_dict)
+    self.assertNotIn("subdir/subsubdir/foosubsub", artifacts_dict)
+
   @unittest.skipIf("symlink" not in os.__dict__, "symlink is not supported in this platform")
   def test_record_without_dead_symlinks(self):
     """Dead symlinks are never recorded. """
@@ -494,10 +523,466 @@ class TestRecordArtifactsAsDict(unittest.TestCase, TmpDirMixin):
       with self.assertRaises(securesystemslib.exceptions.FormatError):
         record_artifacts_as_dict(["."])
 
+  def test_bad_artifact_exclude_patterns_argument(self):
+    """Raise exception with bogus passed artifact exclude patterns. """
+    for exclude_patterns in ["*.pyc", 12345, [12345]]:
+      with self.assertRaises(securesystemslib.exceptions.FormatError):
+        record_artifacts_as_dict(["."], exclude_patterns=exclude_patterns)
+
+  def test_hash_workers(self):
+    """Parallel and serial hashing record the same artifacts. """
+    artifacts_serial = record_artifacts_as_dict(["."], hash_workers=1)
+    artifacts_parallel = record_artifacts_as_dict(["."], hash_workers=4)
+    self.assertDictEqual(artifacts_serial, artifacts_parallel)
+    self.assertListEqual(sorted(artifacts_parallel),
+        sorted(self.full_file_path_list))
+
+  def test_group_by_directory(self):
+    """Test sorted file paths are grouped by directory and group size. """
+    self.assertListEqual(list(in_toto.runlib._group_by_directory(
+        ["bar", "foo", "subdir/foosub1", "subdir/foosub2", "subdir/foosub3",
+        "subdir/subsubdir/foosubsub"], 2)), [
+        ["bar", "foo"], ["subdir/foosub1", "subdir/foosub2"],
+        ["subdir/foosub3"], ["subdir/subsubdir/foosubsub"]])
+
+  @unittest.skipUnless(hasattr(os, "posix_fadvise"), "needs posix_fadvise")
+  def test_iter_prefetched(self):
+    """Test files are opened ahead and closed if not consumed. """
+    prefetch_files_orig = in_toto.runlib._HASH_PREFETCH_FILES
+    in_toto.runlib._HASH_PREFETCH_FILES = 1
+    prefetch_artifact = in_toto.runlib._prefetch_artifact
+    opened = []
+
+    def _prefetch(filepath):
+      opened.append(prefetch_artifact(filepath))
+      return opened[-1]
+
+    try:
+      with patch("in_toto.runlib._prefetch_artifact", side_effect=_prefetch):
+        prefetched = in_toto.runlib._iter_prefetched(
+            ["foo", "not-a-file", "bar"])
+        filepath, file_object = next(prefetched)
+        self.assertEqual(filepath, "foo")
+        self.assertEqual(file_object.read(), b"foo")
+        file_object.close()
+
+        # Missing files are yielded without file, and reported when hashed
+        self.assertEqual(next(prefetched), ("not-a-file", None))
+        with self.assertRaises(securesystemslib.exceptions.StorageError):
+          _hash_artifact("not-a-file")
+
+        # The file opened ahead is closed along with the generator
+        self.assertEqual(len(opened), 3)
+        self.assertFalse(opened[2].closed)
+        prefetched.close()
+        self.assertTrue(opened[2].closed)
+
+    finally:
+      in_toto.runlib._HASH_PREFETCH_FILES = prefetch_files_orig
+
+  def test_hash_pool_process(self):
+    """Hashing in worker processes records the same artifacts. """
+    hash_pool_orig = in_toto.settings.HASH_POOL
+    try:
+      artifacts_threads = record_artifacts_as_dict(["."], hash_workers=2,
+          normalize_line_endings=True)
+      in_toto.settings.HASH_POOL = "process"
+      artifacts_processes = record_artifacts_as_dict(["."], hash_workers=2,
+          normalize_line_endings=True)
+      self.assertDictEqual(artifacts_threads, artifacts_processes)
+
+      # Workers get absolute paths, which resolve relative to the current
+      # working directory of the caller, also if it changes between pools
+      os.chdir("subdir")
+      try:
+        self.assertDictEqual(record_artifacts_as_dict(["."], hash_workers=2,
+            normalize_line_endings=True), record_artifacts_as_dict(["."],
+            hash_workers=1, normalize_line_endings=True))
+      finally:
+        os.chdir("..")
+
+      # Unknown kinds of pools are rejected
+      in_toto.settings.HASH_POOL = "proccess"
+      with self.assertRaises(ValueError):
+        record_artifacts_as_dict(["."])
+
+    finally:
+      in_toto.settings.HASH_POOL = hash_pool_orig
+
+  def test_hash_algorithms(self):
+    """Test recording artifacts passing (bad) hash algorithms. """
+    artifacts_dict = record_artifacts_as_dict(["foo"],
+        hash_algorithms=["sha256", "sha512"])
+    self.assertListEqual(sorted(artifacts_dict["foo"]), ["sha256", "sha512"])
+
+    with self.assertRaises(securesystemslib.exceptions.FormatError):
+      record_artifacts_as_dict(["foo"], hash_algorithms=["not-an-algorithm"])
+
   def test_hash_artifact_passing_algorithm(self):
     """Test _hash_artifact passing hash algorithm. """
     self.assertTrue("sha256" in list(_hash_artifact("foo", ["sha256"])))
 
+  def test_hash_artifact_multiple_algorithms(self):
+    """Test _hash_artifact with multiple algorithms and line endings. """
+    algorithms = ["sha256", "sha512"]
+    # Place a windows line ending across the boundary of two read chunks
+    content = b"a" * (_HASH_CHUNK_SIZE - 1) + b"\r\nb\rc\r"
+    fd, path = tempfile.mkstemp()
+    try:
+      os.write(fd, content)
+      os.close(fd)
+      normalized = content.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+      for normalize_line_endings, data in [
+          (False, content), (True, normalized)]:
+        hash_dict = _hash_artifact(path, algorithms,
+            normalize_line_endings=normalize_line_endings)
+        self.assertDictEqual(hash_dict, {
+            algorithm: hashlib.new(algorithm, data).hexdigest()
+            for algorithm in algorithms})
+
+    finally:
+      os.remove(path)
+
+  def test_hash_artifact_cache(self):
+    """Test _hash_artifact caches hashes of unchanged files. """
+    racy_ns_orig = in_toto.runlib._HASH_CACHE_RACY_NS
+    cache_path_orig = in_toto.settings.HASH_CACHE_PATH
+    in_toto.runlib._HASH_CACHE_RACY_NS = 0
+    in_toto.settings.HASH_CACHE_ENABLED = True
+    cache_dir = tempfile.mkdtemp()
+    in_toto.settings.HASH_CACHE_PATH = os.path.join(cache_dir,
+        "cache", "hashes.sqlite")
+    fd, path = tempfile.mkstemp()
+    try:
+      os.write(fd, b"foo")
+      os.close(fd)
+      sha256 = _hash_artifact(path)["sha256"]
+      self.assertEqual(sha256, hashlib.sha256(b"foo").hexdigest())
+
+      # Unchanged file is not read again
+      cached = "0" * 64
+      for key in in_toto.runlib._HASH_CACHE:
+        in_toto.runlib._HASH_CACHE[key] = cached
+      self.assertEqual(_hash_artifact(path)["sha256"], cached)
+
+      # Cache is persisted and loaded again
+      in_toto.runlib._persist_hash_cache()
+      in_toto.runlib._HASH_CACHE.clear()
+      in_toto.runlib._HASH_CACHE_LOADED_PATHS.clear()
+      self.assertEqual(_hash_artifact(path)["sha256"], sha256)
+
+      # Changed file with same size and modification time is read again
+      file_stat = os.stat(path)
+      with open(path, "wb") as fp:
+        fp.write(b"bar")
+      os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+      self.assertEqual(_hash_artifact(path)["sha256"],
+          hashlib.sha256(b"bar").hexdigest())
+
+      # Cache can be disabled
+      in_toto.settings.HASH_CACHE_ENABLED = False
+      for key in in_toto.runlib._HASH_CACHE:
+        in_toto.runlib._HASH_CACHE[key] = cached
+      self.assertEqual(_hash_artifact(path)["sha256"],
+          hashlib.sha256(b"bar").hexdigest())
+
+      # Cache is not used, where it is not supported
+      in_toto.settings.HASH_CACHE_ENABLED = True
+      with patch("in_toto.runlib._HASH_CACHE_SUPPORTED", False):
+        self.assertEqual(_hash_artifact(path)["sha256"],
+            hashlib.sha256(b"bar").hexdigest())
+
+    finally:
+      in_toto.settings.HASH_CACHE_ENABLED = False
+      in_toto.settings.HASH_CACHE_PATH = cache_path_orig
+      in_toto.runlib._HASH_CACHE_RACY_NS = racy_ns_orig
+      in_toto.runlib._HASH_CACHE.clear()
+      in_toto.runlib._HASH_CACHE_PENDING.clear()
+      in_toto.runlib._HASH_CACHE_LOADED_PATHS.clear()
+      shutil.rmtree(cache_dir)
+      os.remove(path)
+
+  def test_hash_cache_errors(self):
+    """Test unreadable and unwritable hash caches are ignored. """
+    cache_dir = tempfile.mkdtemp()
+    cache_path_orig = in_toto.settings.HASH_CACHE_PATH
+    try:
+      # Corrupt database files are not loaded
+      path = os.path.join(cache_dir, "corrupt.sqlite")
+      with open(path, "wb") as fp:
+        fp.write(b"not a database" * 100)
+      with self.assertLogs("in_toto.runlib", level="WARNING") as logs:
+        in_toto.runlib._load_hash_cache(path)
+      self.assertIn("Could not load hash cache", logs.output[0])
+      self.assertFalse(in_toto.runlib._HASH_CACHE)
+
+      # Pending entries are kept, if they cannot be persisted, e.g. because a
+      # file is in the way of the cache directory
+      in_toto.settings.HASH_CACHE_PATH = os.path.join(path, "hashes.sqlite")
+      in_toto.runlib._add_to_hash_cache(("a",), "a")
+      with self.assertLogs("in_toto.runlib", level="WARNING") as logs:
+        in_toto.runlib._persist_hash_cache()
+      self.assertIn("Could not persist hash cache", logs.output[0])
+      self.assertDictEqual(dict(in_toto.runlib._HASH_CACHE_PENDING),
+          {("a",): "a"})
+
+      # Relative paths in the current working directory are persisted too
+      os.chdir(cache_dir)
+      in_toto.settings.HASH_CACHE_PATH = "hashes.sqlite"
+      in_toto.runlib._persist_hash_cache()
+      self.assertFalse(in_toto.runlib._HASH_CACHE_PENDING)
+      self.assertTrue(os.path.isfile("hashes.sqlite"))
+
+      # Nothing is persisted without pending entries
+      os.remove("hashes.sqlite")
+      in_toto.runlib._persist_hash_cache()
+      self.assertFalse(os.path.exists("hashes.sqlite"))
+
+    finally:
+      os.chdir(self.test_dir)
+      in_toto.settings.HASH_CACHE_PATH = cache_path_orig
+      in_toto.runlib._HASH_CACHE.clear()
+      in_toto.runlib._HASH_CACHE_PENDING.clear()
+      in_toto.runlib._HASH_CACHE_LOADED_PATHS.clear()
+      shutil.rmtree(cache_dir)
+
+  def test_record_artifacts_cache_hits(self):
+    """Test unchanged artifacts recorded again are served from the cache. """
+    racy_ns_orig = in_toto.runlib._HASH_CACHE_RACY_NS
+    in_toto.runlib._HASH_CACHE_RACY_NS = 0
+    in_toto.settings.HASH_CACHE_ENABLED = True
+    with open("baz", "w", encoding="utf8") as fp:
+      fp.write("baz")
+    try:
+      with self.assertLogs("in_toto.runlib", level="INFO") as logs:
+        materials = record_artifacts_as_dict(["bar", "baz"])
+        with open("baz", "w", encoding="utf8") as fp:
+          fp.write("changed")
+        products = record_artifacts_as_dict(["bar", "baz"])
+
+      self.assertEqual(materials["bar"], products["bar"])
+      self.assertNotEqual(materials["baz"], products["baz"])
+      self.assertIn("INFO:in_toto.runlib:Reused cached hashes for 1 of 2"
+          " artifacts...", logs.output)
+
+    finally:
+      in_toto.settings.HASH_CACHE_ENABLED = False
+      in_toto.runlib._HASH_CACHE_RACY_NS = racy_ns_orig
+      in_toto.runlib._HASH_CACHE.clear()
+      os.remove("baz")
+
+  def test_hash_cache_bounded(self):
+    """Test the hash cache evicts the least recently added entries. """
+    cache_dir = tempfile.mkdtemp()
+    cache_path_orig = in_toto.settings.HASH_CACHE_PATH
+    in_toto.settings.HASH_CACHE_PATH = os.path.join(cache_dir,
+        "hashes.sqlite")
+    try:
+      with patch("in_toto.runlib._HASH_CACHE_MAX_ENTRIES", 2):
+        for key in ["a", "b", "a", "c"]:
+          in_toto.runlib._add_to_hash_cache((key,), key)
+        self.assertListEqual(list(in_toto.runlib._HASH_CACHE),
+            [("a",), ("c",)])
+
+        # Persisted and loaded caches are bounded too
+        in_toto.runlib._persist_hash_cache()
+        in_toto.runlib._add_to_hash_cache(("d",), "d")
+        in_toto.runlib._persist_hash_cache()
+        in_toto.runlib._HASH_CACHE.clear()
+        in_toto.runlib._load_hash_cache(in_toto.settings.HASH_CACHE_PATH)
+        self.assertDictEqual(dict(in_toto.runlib._HASH_CACHE),
+            {("c",): "c", ("d",): "d"})
+
+    finally:
+      in_toto.settings.HASH_CACHE_PATH = cache_path_orig
+      in_toto.runlib._HASH_CACHE.clear()
+      in_toto.runlib._HASH_CACHE_PENDING.clear()
+      in_toto.runlib._HASH_CACHE_LOADED_PATHS.clear()
+      shutil.rmtree(cache_dir)
+
+  def test_record_artifacts_hard_links(self):
+    """Test hard links to the same file are read only once per call. """
+    os.link("bar", "baz")
+    in_toto.settings.HASH_CACHE_ENABLED = False
+    try:
+      with patch("in_toto.runlib._digest_file_object",
+          wraps=in_toto.runlib._digest_file_object) as digest:
+        artifacts = record_artifacts_as_dict(["bar", "baz"])
+      self.assertEqual(digest.call_count, 1)
+      self.assertDictEqual(artifacts["bar"], artifacts["baz"])
+      self.assertIsNot(artifacts["bar"], artifacts["baz"])
+
+    finally:
+      os.remove("baz")
+
+  def test_hash_artifact_mmap(self):
+    """Test _hash_artifact memory-mapping (empty) files. """
+    threshold_orig = in_toto.runlib._HASH_MMAP_THRESHOLD
+    in_toto.runlib._HASH_MMAP_THRESHOLD = 0
+    fd, path = tempfile.mkstemp()
+    try:
+      os.close(fd)
+      # Empty files cannot be mapped and are read instead
+      self.assertEqual(_hash_artifact(path)["sha256"],
+          hashlib.sha256(b"").hexdigest())
+
+      with open(path, "wb") as fp:
+        fp.write(b"foo\r\n")
+      self.assertDictEqual(_hash_artifact(path, ["sha256", "sha512"]), {
+          "sha256": hashlib.sha256(b"foo\r\n").hexdigest(),
+          "sha512": hashlib.sha512(b"foo\r\n").hexdigest()})
+
+      # Files are not mapped, if line endings are normalized
+      self.assertEqual(
+          _hash_artifact(path, normalize_line_endings=True)["sha256"],
+          hashlib.sha256(b"foo\n").hexdigest())
+
+    finally:
+      in_toto.runlib._HASH_MMAP_THRESHOLD = threshold_orig
+      os.remove(path)
+
+  def test_hash_artifact_tree_hash(self):
+    """Test _hash_artifact with block-wise tree hash, mapped and read. """
+    block_size = 1 << 20
+    data = os.urandom(3 * block_size + 5)
+    expected = hashlib.sha256(b"".join(
+        hashlib.sha256(data[i:i + block_size]).digest()
+        for i in range(0, len(data), block_size))).hexdigest()
+
+    fd, path = tempfile.mkstemp()
+    threshold_orig = in_toto.runlib._HASH_MMAP_THRESHOLD
+    try:
+      os.close(fd)
+      self.assertEqual(_hash_artifact(path, ["sha256-tree-1m"]),
+          {"sha256-tree-1m": hashlib.sha256(b"").hexdigest()})
+
+      with open(path, "wb") as fp:
+        fp.write(data)
+
+      for threshold in [0, threshold_orig]:
+        in_toto.runlib._HASH_MMAP_THRESHOLD = threshold
+        self.assertDictEqual(
+            _hash_artifact(path, ["sha256", "sha256-tree-1m"]), {
+                "sha256": hashlib.sha256(data).hexdigest(),
+                "sha256-tree-1m": expected})
+
+      # Tree hash algorithms are accepted by record_artifacts_as_dict
+      artifacts_dict = record_artifacts_as_dict([path],
+          hash_algorithms=["sha256-tree-1m"])
+      self.assertEqual(artifacts_dict[path], {"sha256-tree-1m": expected})
+
+    finally:
+      in_toto.runlib._HASH_MMAP_THRESHOLD = threshold_orig
+      os.remove(path)
+
+  def test_tree_digest_update_parallel(self):
+    """Test parallel tree hash updates after a partially filled block. """
+    data = os.urandom(10 * 7 + 3)
+    expected = in_toto.runlib._TreeDigest("sha256", 10)
+    expected.update(data)
+    for first in [0, 4, 10]:
+      digest = in_toto.runlib._TreeDigest("sha256", 10)
+      digest.update(data[:first])
+      digest.update_parallel(data[first:], max_workers=2)
+      self.assertEqual(digest.hexdigest(), expected.hexdigest())
+
+  def test_hash_artifact_block_workers(self):
+    """Test single files are hashed block-wise with the passed workers. """
+    threshold_orig = in_toto.runlib._HASH_MMAP_THRESHOLD
+    in_toto.runlib._HASH_MMAP_THRESHOLD = 0
+    blake3_orig = in_toto.runlib.blake3
+    in_toto.runlib.blake3 = MagicMock()
+    in_toto.runlib.blake3.blake3.return_value.hexdigest.return_value = "0"
+    try:
+      for hash_workers, parallel_calls in [(1, 0), (3, 1)]:
+        with patch("in_toto.runlib._TreeDigest.update_parallel",
+            autospec=True) as update_parallel:
+          record_artifacts_as_dict(["foo"], hash_workers=hash_workers,
+              hash_algorithms=["sha256-tree-1m", "blake3"])
+
+        self.assertEqual(update_parallel.call_count, parallel_calls)
+        if parallel_calls:
+          self.assertEqual(update_parallel.call_args.args[2], hash_workers)
+        in_toto.runlib.blake3.blake3.assert_called_with(
+            max_threads=hash_workers)
+
+      # Files are not hashed block-wise, if the workers hash several files
+      with patch("in_toto.runlib._TreeDigest.update_parallel") as \
+          update_parallel:
+        record_artifacts_as_dict(["foo", "bar"], hash_workers=3,
+            hash_algorithms=["sha256-tree-1m", "blake3"])
+      update_parallel.assert_not_called()
+      in_toto.runlib.blake3.blake3.assert_called_with(max_threads=1)
+
+    finally:
+      in_toto.runlib.blake3 = blake3_orig
+      in_toto.runlib._HASH_MMAP_THRESHOLD = threshold_orig
+
+  def test_hash_artifact_buffer_reuse(self):
+    """Test _hash_artifact reuses the read buffer of the current thread. """
+    # Disable the cache, which would skip reading files
+    in_toto.settings.HASH_CACHE_ENABLED = False
+    try:
+      # Files are only read into the buffer for multiple algorithms or
+      # without hashlib.file_digest
+      self.assertEqual(_hash_artifact("foo", ["sha256", "sha512"])["sha256"],
+          hashlib.sha256(b"foo").hexdigest())
+      buf = in_toto.runlib._HASH_BUFFERS.buf
+      self.assertEqual(_hash_artifact("bar", ["sha256", "sha512"])["sha256"],
+          hashlib.sha256(b"bar").hexdigest())
+      self.assertIs(in_toto.runlib._HASH_BUFFERS.buf, buf)
+
+    finally:
+      in_toto.settings.HASH_CACHE_ENABLED = False
+
+  def test_hash_artifact_blake3(self):
+    """Test _hash_artifact with optional blake3, installed or not. """
+    blake3_orig = in_toto.runlib.blake3
+    try:
+      in_toto.runlib.blake3 = None
+      with self.assertRaises(
+          securesystemslib.exceptions.UnsupportedAlgorithmError):
+        _hash_artifact("foo", ["blake3"])
+
+    finally:
+      in_toto.runlib.blake3 = blake3_orig
+
+    if blake3_orig is not None: # pragma: no cover
+      self.assertEqual(_hash_artifact("foo", ["blake3"])["blake3"],
+          blake3_orig.blake3(b"foo").hexdigest())
+
+  def test_hash_artifact_noatime_fallback(self):
+    """Test _hash_artifact opens files without O_NOATIME if not permitted. """
+    os_open = os.open
+    noatime = getattr(os, "O_NOATIME", 0)
+
+    def _open(path, flags, *args):
+      if noatime and flags & noatime:
+        raise PermissionError
+      return os_open(path, flags, *args)
+
+    with patch("os.open", side_effect=_open):
+      self.assertEqual(
+          _hash_artifact("foo", ["sha256", "sha512"])["sha256"],
+          hashlib.sha256(b"foo").hexdigest())
+
+  def test_open_artifact_fdopen_error(self):
+    """Test _open_artifact closes the file descriptor, if fdopen fails. """
+    with patch("os.fdopen", side_effect=ValueError), \
+        patch("os.close", wraps=os.close) as close:
+      with self.assertRaises(ValueError):
+        in_toto.runlib._open_artifact("foo")
+    close.assert_called_once()
+
+  def test_hash_artifact_errors(self):
+    """Test _hash_artifact with bad algorithm and missing file. """
+    with self.assertRaises(
+        securesystemslib.exceptions.UnsupportedAlgorithmError):
+      _hash_artifact("foo", ["not-an-algorithm"])
+
+    with self.assertRaises(securesystemslib.exceptions.StorageError):
+      _hash_artifact("not-a-file")
+
 
 class TestLinkCmdExecTimeoutSetting(unittest.TestCase):
   """Tests LINK_CMD_EXEC_TIMEOUT setting in settings.py file. """
@@ -524,6 +1009,29 @@ class TestLinkCmdExecTimeoutSetting(unittest.TestCase):
 
 class TestSubprocess(unittest.TestCase):
 
+  def test_execute_link_record_streams_no_tty(self):
+    """Test recorded streams are captured and written without a terminal. """
+    cmd = [
+      sys.executable,
+      "-c",
+      "import sys; sys.stdout.write('foo'); sys.stderr.write('bar')"
+    ]
+    real_stdout = sys.stdout
+    real_stderr = sys.stderr
+    sys.stdout = io.StringIO()
+    sys.stderr = io.StringIO()
+    try:
+      byproducts = in_toto.runlib.execute_link(cmd, True)
+      self.assertEqual(sys.stdout.getvalue(), "foo")
+      self.assertEqual(sys.stderr.getvalue(), "bar")
+
+    finally:
+      sys.stdout = real_stdout
+      sys.stderr = real_stderr
+
+    self.assertDictEqual(byproducts,
+        {"stdout": "foo", "stderr": "bar", "return-value": 0})
+
   def test_run_duplicate_streams(self):
     """Test output indeed duplicated."""
     # Command that prints 'foo' to stdout and 'bar' to stderr.
@@ -579,12 +1087,108 @@ class TestSubprocess(unittest.TestCase):
     ret_code, _, _ = _subprocess_run_duplicate_streams(cmd, 10)
     self.assertEqual(ret_code, 100)
 
+  def test_run_duplicate_streams_large_output(self):
+    """Test output larger than pipe buffers and read size is captured. """
+    cmd = [
+      sys.executable,
+      "-c",
+      "import sys; sys.stdout.write('foo\\r\\n' * 100000);"
+      " sys.stderr.write('bar' * 100000)"
+    ]
+    real_stdout = sys.stdout
+    real_stderr = sys.stderr
+    sys.stdout = io.StringIO()
+    sys.stderr = io.StringIO()
+    try:
+      ret_code, ret_out, ret_err = _subprocess_run_duplicate_streams(cmd, 10)
+      self.assertEqual(sys.stdout.getvalue(), ret_out)
+      self.assertEqual(sys.stderr.getvalue(), ret_err)
+
+    finally:
+      sys.stdout = real_stdout
+      sys.stderr = real_stderr
+
+    self.assertEqual(ret_code, 0)
+    # Line endings are translated as with `universal_newlines=True`
+    self.assertEqual(ret_out, "foo\n" * 100000)
+    self.assertEqual(ret_err, "bar" * 100000)
+
   def test_run_duplicate_streams_timeout(self):
     """Test timeout."""
     cmd = [sys.executable,  "-c", "while True: pass"]
     with self.assertRaises(subprocess.TimeoutExpired ):
       _subprocess_run_duplicate_streams(cmd, timeout=-1)
 
+  def test_run_duplicate_streams_background_process(self):
+    """Test return once the command exits, if streams are still open. """
+    # Command that leaves a background process holding its standard streams
+    cmd = [
+      sys.executable,
+      "-c",
+      "import subprocess, sys;"
+      " subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)']);"
+      " sys.stdout.write('foo\\r')"
+    ]
+    real_stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+      for run in [_subprocess_run_duplicate_streams,
+          in_toto.runlib._subprocess_run_duplicate_streams_tempfile]:
+        self.assertEqual(run(cmd, 3), (0, "foo\n", ""))
+
+      timeout_orig = in_toto.settings.LINK_CMD_EXEC_TIMEOUT
+      in_toto.settings.LINK_CMD_EXEC_TIMEOUT = 3
+      try:
+        self.assertDictEqual(in_toto.runlib.execute_link(cmd, True),
+            {"stdout": "foo\n", "stderr": "", "return-value": 0})
+      finally:
+        in_toto.settings.LINK_CMD_EXEC_TIMEOUT = timeout_orig
+
+    finally:
+      sys.stdout = real_stdout
+
+  def test_execute_link_record_streams_timeout(self):
+    """Test recorded streams are written while the command runs. """
+    cmd = [sys.executable, "-c",
+        "import sys, time; print('progress', flush=True); time.sleep(10)"]
+    timeout_orig = in_toto.settings.LINK_CMD_EXEC_TIMEOUT
+    in_toto.settings.LINK_CMD_EXEC_TIMEOUT = 1
+    real_stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+      with self.assertRaises(subprocess.TimeoutExpired):
+        in_toto.runlib.execute_link(cmd, True)
+      self.assertEqual(sys.stdout.getvalue(), "progress\n")
+
+    finally:
+      in_toto.settings.LINK_CMD_EXEC_TIMEOUT = timeout_orig
+      sys.stdout = real_stdout
+
+  def test_run_duplicate_streams_tempfile(self):
+    """Test fallback with temporary files. """
+    run = in_toto.runlib._subprocess_run_duplicate_streams_tempfile
+    cmd = [
+      sys.executable,
+      "-c",
+      "import sys; sys.stdout.write('foo' * 10000); sys.stderr.write('bar');"
+      " sys.exit(100)"
+    ]
+    real_stdout = sys.stdout
+    real_stderr = sys.stderr
+    sys.stdout = io.StringIO()
+    sys.stderr = io.StringIO()
+    try:
+      self.assertEqual(run(cmd, 10), (100, "foo" * 10000, "bar"))
+      self.assertEqual(sys.stdout.getvalue(), "foo" * 10000)
+      self.assertEqual(sys.stderr.getvalue(), "bar")
+
+    finally:
+      sys.stdout = real_stdout
+      sys.stderr = real_stderr
+
+    with self.assertRaises(subprocess.TimeoutExpired):
+      run([sys.executable, "-c", "while True: pass"], timeout=-1)
+
 class TestInTotoRun(unittest.TestCase, TmpDirMixin):
   """"
   Tests runlib.in_toto_run() with different arguments
@@ -876,6 +1480,99 @@ class TestInTotoRecordStop(unittest.TestCase, TmpDirMixin):
     self.assertEqual(list(link.signed.products.keys()), [self.test_product])
     os.remove(self.link_name)
 
+  def test_find_unfinished_links_for_default_gpg_key(self):
+    """Test record stop fails without exactly one preliminary link. """
+    with self.assertRaises(in_toto.exceptions.LinkNotFoundError):
+      in_toto_record_stop(self.step_name, [], gpg_use_default=True)
+
+    names = [".{}.{}.link-unfinished".format(self.step_name, keyid)
+        for keyid in ["aaaaaaaa", "bbbbbbbb"]]
+    # Links of steps whose names start with the step name don't match
+    other_names = [".{}{}.cccccccc.link-unfinished".format(self.step_name, sep)
+        for sep in ["-other", ".other"]]
+    for name in names + other_names:
+      Path(name).touch()
+
+    try:
+      self.assertListEqual(sorted(in_toto._link_files.find_unfinished(
+          self.step_name, max_matches=3)), names)
+      with self.assertRaises(in_toto.exceptions.LinkNotFoundError):
+        in_toto_record_stop(self.step_name, [], gpg_use_default=True)
+
+    finally:
+      for name in names + other_names:
+        os.remove(name)
+
+  def test_get_signer(self):
+    """Test signers for signing keys and gpg keys. """
+    signer = in_toto.runlib._get_signer(gpg_keyid="aaaaaaaa", gpg_home="home")
+    self.assertEqual((signer.keyid, signer.homedir), ("aaaaaaaa", "home"))
+    signer = in_toto.runlib._get_signer(gpg_home="home")
+    self.assertEqual((signer.keyid, signer.homedir), (None, "home"))
+    self.assertEqual(in_toto.runlib._get_signer(self.key).key_dict, self.key)
+
+  def test_create_metadata_with_durable_writes(self):
+    """Test record start/stop syncing link metadata, without temp files. """
+    with patch("in_toto._link_files.fsync_directory",
+        wraps=in_toto._link_files.fsync_directory) as fsync_dir:
+      in_toto_record_start(self.step_name, [], self.key, durable_writes=True)
+      self.assertFalse(os.path.exists(self.link_name_unfinished + ".tmp"))
+      # The renamed preliminary link is synced with its directory
+      self.assertEqual(fsync_dir.call_count, 1)
+
+      in_toto_record_stop(self.step_name, [self.test_product], self.key,
+          durable_writes=True)
+      self.assertFalse(os.path.exists(self.link_name + ".tmp"))
+      # Both links are in the same directory, which is synced once
+      self.assertEqual(fsync_dir.call_count, 2)
+
+    link = Metablock.load(self.link_name)
+    self.assertEqual(list(link.signed.products.keys()), [self.test_product])
+    os.remove(self.link_name)
+
+  def test_create_metadata_with_base_path(self):
+    """Test record stop loads preliminary link while hashing in base path. """
+    base_path = os.path.realpath(tempfile.mkdtemp(dir=os.getcwd()))
+    Path(os.path.join(base_path, self.test_product)).touch()
+    in_toto_record_start(self.step_name, [], self.key)
+    in_toto_record_stop(self.step_name, [self.test_product], self.key,
+        base_path=base_path)
+    link = Metablock.load(self.link_name)
+    self.assertEqual(list(link.signed.products.keys()), [self.test_product])
+    self.assertFalse(os.path.exists(self.link_name_unfinished))
+    os.remove(self.link_name)
+    shutil.rmtree(base_path)
+
+  def test_create_metadata_with_hash_workers(self):
+    """Test record start/stop hashing serially and in parallel. """
+    for hash_workers in [1, 4]:
+      in_toto_record_start(self.step_name, [self.test_product], self.key,
+          hash_workers=hash_workers)
+      in_toto_record_stop(self.step_name, [self.test_product], self.key,
+          hash_workers=hash_workers)
+      link = Metablock.load(self.link_name)
+      self.assertEqual(list(link.signed.materials.keys()), [self.test_product])
+      self.assertEqual(link.signed.materials, link.signed.products)
+      os.remove(self.link_name)
+
+  def test_no_threads_while_forking_hash_workers(self):
+    """Test record stop loads the preliminary link first, if it forks. """
+    record_artifacts = in_toto.runlib.record_artifacts_as_dict
+    thread_counts = []
+
+    def _record(*args, **kwargs):
+      thread_counts.append(threading.active_count())
+      return record_artifacts(*args, **kwargs)
+
+    in_toto_record_start(self.step_name, [], self.key)
+    with patch("in_toto.runlib._forks_hash_workers", return_value=True), \
+        patch("in_toto.runlib.record_artifacts_as_dict", side_effect=_record):
+      in_toto_record_stop(self.step_name, [self.test_product], self.key,
+          normalize_line_endings=True)
+
+    self.assertEqual(thread_counts, [threading.active_count()])
+    os.remove(self.link_name)
+
   def test_compare_metadata_with_and_without_metadata_directory(self):
     """Test record stop with and without metadata directory,
      compare the expected product"""
@@ -944,6 +1641,29 @@ class TestInTotoRecordStop(unittest.TestCase, TmpDirMixin):
     os.rename(changed_link_name, link_name)
     os.remove(self.link_name_unfinished)
 
+  def test_skip_preliminary_verify(self):
+    """Test record stop only checks the keyid if verification is skipped. """
+    for use_dsse in [False, True]:
+      in_toto_record_start(self.step_name, [], self.key, use_dsse=use_dsse)
+      with patch.object(Envelope, "verify_signature") as envelope_verify, \
+          patch.object(Metablock, "verify_signature") as metablock_verify:
+        in_toto_record_stop(self.step_name, [], self.key,
+            skip_preliminary_verify=True)
+      envelope_verify.assert_not_called()
+      metablock_verify.assert_not_called()
+      Metadata.load(self.link_name).verify_signature(self.key)
+      os.remove(self.link_name)
+
+    # The preliminary link must still have a signature by the passed key
+    in_toto_record_start(self.step_name, [], self.key)
+    changed_link_name = UNFINISHED_FILENAME_FORMAT.format(
+        step_name=self.step_name, keyid=self.key2["keyid"])
+    os.rename(self.link_name_unfinished, changed_link_name)
+    with self.assertRaises(SignatureVerificationError):
+      in_toto_record_stop(self.step_name, [], self.key2,
+          skip_preliminary_verify=True)
+    os.remove(changed_link_name)
+
   def test_no_key_arguments(self):
     """Test record stop without passing one required key argument. """
     with self.assertRaises(ValueError):
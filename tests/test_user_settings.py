@@ -20,6 +20,7 @@
 """
 import os
 import unittest
+from unittest.mock import patch
 import in_toto.settings
 import in_toto.user_settings
 
@@ -119,5 +120,35 @@ class TestUserSettings(unittest.TestCase):
     self.assertRaises(AttributeError, getattr, in_toto.settings,
         "NOT_WHITELISTED")
 
+
+  def test_set_settings_parsed(self):
+    """ Test parsing boolean, integer and path settings. """
+    with patch.dict(os.environ, {
+        "IN_TOTO_HASH_WORKERS": "4",
+        "IN_TOTO_HASH_POOL": "process",
+        "IN_TOTO_HASH_CACHE_ENABLED": "No",
+        "IN_TOTO_HASH_CACHE_PATH": "C:/cache:hashes.sqlite"}):
+      in_toto.user_settings.set_settings()
+
+    self.assertEqual(in_toto.settings.HASH_WORKERS, 4)
+    self.assertEqual(in_toto.settings.HASH_POOL, "process")
+    self.assertIs(in_toto.settings.HASH_CACHE_ENABLED, False)
+    self.assertEqual(in_toto.settings.HASH_CACHE_PATH,
+        "C:/cache:hashes.sqlite")
+
+    with patch.dict(os.environ, {"IN_TOTO_HASH_CACHE_ENABLED": "ON"}):
+      in_toto.user_settings.set_settings()
+    self.assertIs(in_toto.settings.HASH_CACHE_ENABLED, True)
+
+    # Invalid values are ignored
+    for value in ["0", "-1", "many"]:
+      with patch.dict(os.environ, {"IN_TOTO_HASH_WORKERS": value,
+          "IN_TOTO_HASH_CACHE_ENABLED": "maybe"}):
+        with self.assertLogs("in_toto.user_settings", level="WARNING"):
+          in_toto.user_settings.set_settings()
+      self.assertEqual(in_toto.settings.HASH_WORKERS, 4)
+      self.assertIs(in_toto.settings.HASH_CACHE_ENABLED, True)
+
+
 if __name__ == "__main__":
   unittest.main()